@@ -0,0 +1,107 @@
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from model import DEL, ZeroerModel, _centered_cov, get_y_init_given_threshold
+
+""" Micro-benchmark of one EM iteration of ZeroerModel on a synthetic
+similarity matrix (two Gaussian-ish classes clipped to [0, 1]): time of
+e_step and m_step, and time and peak allocated memory of the M-step
+statistics (class means and covariances) against computing them the direct
+way (tiled means and centered N x M copies). Prints the largest difference
+between the two covariances.
+
+python bench_em_step.py --rows 1000000 --cols 40 --iterations 5 [--dtype float32]
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--rows", type=int, default=1000000)
+parser.add_argument("--cols", type=int, default=40)
+parser.add_argument("--group_size", type=int, default=4, help="features per attribute (covariance group)")
+parser.add_argument("--match_rate", type=float, default=0.01)
+parser.add_argument("--iterations", type=int, default=5)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"], help="EM storage dtype")
+
+
+def make_similarity_matrix(rows, cols, match_rate, seed):
+    rng = np.random.default_rng(seed)
+    matches = rng.random(rows) < match_rate
+    X = rng.normal(0.25, 0.12, (rows, cols))
+    X[matches] = rng.normal(0.8, 0.1, (int(matches.sum()), cols))
+    return np.clip(X, 0, 1)
+
+
+def direct_statistics(X, P_M):
+    """Class means and covariances as m_step used to compute them."""
+    N = X.shape[0]
+    P_U = 1. - P_M
+    N_M = np.sum(P_M)
+    N_U = N - N_M
+    P_M, P_U = P_M.reshape(N, 1), P_U.reshape(N, 1)
+    Mu_M = np.sum(P_M * X, axis=0) / (N_M + DEL)
+    Mu_U = np.sum(P_U * X, axis=0) / (N_U + DEL)
+    std_M = np.sqrt(np.sum(P_M * ((X - np.tile(Mu_M, (N, 1))) ** 2), axis=0) / (N_M + DEL)) + 1e-100
+    std_U = np.sqrt(np.sum(P_U * ((X - np.tile(Mu_U, (N, 1))) ** 2), axis=0) / (N_U + DEL)) + 1e-100
+    Cov_M = np.dot(np.transpose(X - Mu_M), P_M * (X - Mu_M)) / (N_M + DEL)
+    Cov_U = np.dot(np.transpose(X - Mu_U), P_U * (X - Mu_U)) / (N_U + DEL)
+    return Cov_M, Cov_U
+
+
+def sufficient_statistics(model, P_M):
+    """Class covariances from the sufficient statistics m_step computes."""
+    P_U = 1. - P_M
+    N_M = np.sum(P_M)
+    N_U = P_M.shape[0] - N_M
+    (S1_M, S2_M), (S1_U, S2_U) = model._class_moments(P_M, P_U, model.Mu_M, model.Mu_U)
+    return _centered_cov(S1_M, S2_M, N_M, S1_M / (N_M + DEL)), _centered_cov(S1_U, S2_U, N_U, S1_U / (N_U + DEL))
+
+
+def resident_mb():
+    """Current resident memory (Linux), None elsewhere."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def timed(fn, *args):
+    """(result, seconds, peak MB allocated while fn ran)."""
+    tracemalloc.start()
+    start = time.time()
+    result = fn(*args)
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    X = make_similarity_matrix(args.rows, args.cols, args.match_rate, args.seed)
+    feature_names = [f"attr{j // args.group_size}_feature{j}" for j in range(args.cols)]
+    print(f"{args.rows:,} x {args.cols} similarity matrix ({X.nbytes / 2**20:.0f} MB)")
+    start = time.time()
+    y_init = get_y_init_given_threshold(pd.DataFrame(X))
+    model = ZeroerModel(X, feature_names, y_init, None, c_bay=0.015, dtype=np.dtype(args.dtype))
+    del X
+    print(f"model initialized in {time.time() - start:.2f}s, X stored as {model.X.dtype} ({model.X.nbytes / 2**20:.0f} MB)")
+
+    for iteration in range(args.iterations):
+        _, e_time, _ = timed(model.e_step)
+        P_M = model.P_M.copy()
+        direct, direct_time, direct_peak = timed(direct_statistics, model.X, P_M)
+        stats, stats_time, stats_peak = timed(sufficient_statistics, model, P_M)
+        _, m_time, m_peak = timed(model.m_step)
+        cov_diff = max(np.max(np.abs(stats[0] - direct[0])), np.max(np.abs(stats[1] - direct[1])))
+        print(f"iteration {iteration}: e_step {e_time:6.2f}s | m_step {m_time:6.2f}s, peak {m_peak:6.1f} MB | "
+              f"statistics {stats_time:6.2f}s, peak {stats_peak:6.1f} MB, direct {direct_time:6.2f}s, "
+              f"peak {direct_peak:7.1f} MB | max covariance diff {cov_diff:.2g}")
+    del direct, stats
+    print(f"resident memory after the iterations: {resident_mb()} MB")
@@ -0,0 +1,86 @@
+import argparse
+import time
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from blocking_functions import blocking_functions_mapping
+from data_loading_helper.data_loader import load_tables
+from data_loading_helper.feature_extraction import add_labels_to_candset, get_feature_table
+from data_loading_helper.token_features import TokenCache, extract_set_features, is_set_feature
+
+""" Benchmark of the set-based similarity features (jaccard, cosine, dice,
+overlap_coeff): em.extract_feature_vecs against the sparse token-matrix path
+of data_loading_helper.token_features, on the same candidate set. Prints the
+time of both and the largest difference between their feature values.
+
+python bench_feature_extraction.py fodors_zagats --repeat 10
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("datasets", type=str, nargs="+")
+parser.add_argument("--n_jobs", type=int, default=1, help="n_jobs passed to em.extract_feature_vecs")
+parser.add_argument("--repeat", type=int, default=1,
+                    help="replicate the candidate set this many times, to time the sparse path on larger candsets")
+parser.add_argument("--skip_magellan", type=bool, default=False, nargs="?", const=True,
+                    help="only time the sparse path (em.extract_feature_vecs takes hours on millions of pairs)")
+parser.add_argument("--chunk_size", type=int, default=200000)
+
+data_path = "datasets"
+
+
+def load_dataset(dataset_name):
+    dataset_path = join(data_path, dataset_name)
+    with open(join(dataset_path, "metadata.txt")) as f:
+        names = [line.strip() for line in f if line.strip()]
+    blocking_fn = blocking_functions_mapping[dataset_name]
+    A, B, G = load_tables(join(dataset_path, names[0]), join(dataset_path, names[1]), join(dataset_path, names[2]), blocking_fn)
+    C = blocking_fn(A, B)
+    for df, col in ((A, "id"), (B, "id"), (C, "ltable_id"), (C, "rtable_id")):
+        df[col] = df[col].astype(str)
+    G = G if G is not None else pd.DataFrame(columns=["ltable_id", "rtable_id"])
+    G = G.iloc[:, :2].astype(str)
+    C = add_labels_to_candset(G, C, A, B)
+    return A, B, C
+
+
+def bench(dataset_name, args):
+    import py_entitymatching as em
+
+    A, B, C = load_dataset(dataset_name)
+    feature_records, tokenizers = get_feature_table(A, B)
+    set_features = feature_records.apply(lambda feature: is_set_feature(feature, tokenizers), axis=1).values
+    set_records = feature_records.loc[set_features, :]
+    feature_names = list(set_records.feature_name)
+    print(f"\n{dataset_name}: {len(A)} x {len(B)} records, {len(C):,} candidate pairs, {len(feature_names)} set-based features")
+
+    l_idx = pd.Index(A["id"]).get_indexer(C["ltable_id"])
+    r_idx = pd.Index(B["id"]).get_indexer(C["rtable_id"])
+    cache = TokenCache(tokenizers)
+    start = time.time()
+    sparse_df = extract_set_features(A, B, l_idx, r_idx, set_records, tokenizers, cache, args.chunk_size).fillna(0)
+    sparse_time = time.time() - start
+    print(f"  sparse token matrices: {sparse_time:8.2f}s")
+
+    if args.repeat > 1:
+        #Tokenization is cached, this times the chunked intersection and scoring on a larger candset
+        l_rep, r_rep = np.tile(l_idx, args.repeat), np.tile(r_idx, args.repeat)
+        start = time.time()
+        extract_set_features(A, B, l_rep, r_rep, set_records, tokenizers, cache, args.chunk_size)
+        print(f"  sparse, {len(l_rep):,} pairs (tokens cached): {time.time() - start:8.2f}s")
+
+    if not args.skip_magellan:
+        start = time.time()
+        magellan_df = em.extract_feature_vecs(C, feature_table=set_records, show_progress=False, n_jobs=args.n_jobs)
+        magellan_time = time.time() - start
+        magellan_df.fillna(value=0, inplace=True)
+        max_diff = np.max(np.abs(magellan_df[feature_names].values - sparse_df[feature_names].values))
+        print(f"  em.extract_feature_vecs: {magellan_time:8.2f}s (speedup {magellan_time / sparse_time:.1f}x)")
+        print(f"  max abs difference: {max_diff:.3g}")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    for dataset_name in args.datasets:
+        bench(dataset_name, args)
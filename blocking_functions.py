@@ -1,9 +1,19 @@
 from collections import defaultdict
+import functools
+import re
+import string
 
+import numpy as np
+import pandas as pd
 from pandas import merge
+from scipy.sparse import csr_matrix
 import py_entitymatching as em
 import os
 
+from data_loading_helper.blocking_report import pair_keys
+from data_loading_helper.candidate_set import per_pair_blocker
+from data_loading_helper.data_loader import table_preprocessor
+
 def get_n_jobs():
     """Get n_jobs from environment variable, default to 4"""
     return int(os.environ.get('ZEROER_N_JOBS', '4'))
@@ -18,84 +28,386 @@ two tables.
 
 
 def verify_blocking_ground_truth(A, B, block_df, duplicates_df, objectify=False):
-    num_duplicates_missed = 0
-    duplicates_df.columns = ["ltable_id", "rtable_id"]
-    # Sometimes pandas / Magellan puts some columns as objects instead of numeric/string. In this case, we will force this to join appropriately
-    if objectify:
-        duplicates_df = duplicates_df.astype(object)
-
-    # Intuition: merge function joints two data frames. The outer option creates a number of NaN rows when
-    # some duplicates are missing in the blocked_df
-    # we leverage the fact that len gives all rows while count gives non-NaN to compute the missing options
-    merged_df = block_df.merge(duplicates_df, left_on=["ltable_id", "rtable_id"], right_on=["ltable_id", "rtable_id"],
-                               how='outer')
-    num_duplicates_missed = len(merged_df) - merged_df["_id"].count()
-    total_duplicates = len(duplicates_df)
-
-    print("Ratio saved=", 1.0 - float(len(block_df)) / float(len(A) * len(B)))
+    """
+    Print and return the reduction ratio and the ground-truth pairs missed by
+    a candset. Pairs are compared as int64 keys of the id pairs with the
+    ground truth ids normalized to the candset's, so objectify is no longer
+    needed and kept for old callers.
+    """
+    candidate_keys, match_keys = pair_keys(block_df["ltable_id"].values, block_df["rtable_id"].values, duplicates_df)
+    match_keys = np.unique(match_keys)
+    num_duplicates_missed = int((~np.isin(match_keys, candidate_keys)).sum())
+    total_duplicates = len(match_keys)
+    reduction_ratio = 1.0 - float(len(block_df)) / float(len(A) * len(B))
+
+    print("Ratio saved=", reduction_ratio)
     print("Totally missed:", num_duplicates_missed, " out of ", total_duplicates)
+    return reduction_ratio, num_duplicates_missed, total_duplicates
+
+
+#Stop words removed by em.OverlapBlocker with rem_stop_words=True
+OVERLAP_STOP_WORDS = ['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'he', 'in', 'is', 'it',
+                      'its', 'on', 'that', 'the', 'to', 'was', 'were', 'will', 'with']
+_punctuation = re.compile('[%s]' % re.escape(string.punctuation))
+
+
+def _overlap_tokens(value, word_level, q_val, rem_stop_words):
+    """Token set of a value as em.OverlapBlocker sees it (lower case, no punctuation), None if missing."""
+    if pd.isnull(value):
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'ignore')
+    words = _punctuation.sub('', str(value).lower()).split()
+    if rem_stop_words:
+        words = [word for word in words if word not in OVERLAP_STOP_WORDS]
+    if word_level:
+        return set(words)
+    #Magellan q-grams the de-duplicated words joined by spaces (in set order, here in first-occurrence order)
+    text = '#' * (q_val - 1) + ' '.join(dict.fromkeys(words)) + '$' * (q_val - 1)
+    return {text[i:i + q_val] for i in range(len(text) - q_val + 1)}
+
+
+def _expand_ranges(starts, stops):
+    lengths = stops - starts
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + (np.arange(lengths.sum()) - offsets)
+
+
+class OverlapIndex:
+    """
+    Token sets of the overlap attributes of two tables, tokenized once, with
+    every token replaced by its rank in a global order of increasing
+    document frequency. Each record's ranks are sorted, so the first
+    |tokens| - overlap_size + 1 of them are its prefix for prefix filtering:
+    two records sharing at least overlap_size tokens share a prefix token.
+    candidates() can be called for several overlap sizes on one index.
+    A self-join (A is B, on the same attribute) is tokenized once and by
+    default yields every unordered pair once.
+    """
+
+    def __init__(self, A, B, l_overlap_attr, r_overlap_attr, word_level=True, q_val=None, rem_stop_words=False):
+        self.self_join = A is B and l_overlap_attr == r_overlap_attr
+        vocabulary = {}
+        tables = []
+        for table, attr in ((A, l_overlap_attr),) if self.self_join else ((A, l_overlap_attr), (B, r_overlap_attr)):
+            indptr, tokens, missing = [0], [], []
+            for value in table[attr].values:
+                token_set = _overlap_tokens(value, word_level, q_val, rem_stop_words)
+                missing.append(token_set is None)
+                tokens.extend(vocabulary.setdefault(token, len(vocabulary)) for token in token_set or ())
+                indptr.append(len(tokens))
+            tables.append((np.array(indptr, dtype=np.int64), np.array(tokens, dtype=np.int64), np.array(missing)))
+        if self.self_join:
+            tables.append(tables[0])
+        frequency = np.bincount(np.concatenate([tokens for _, tokens, _ in tables]), minlength=len(vocabulary))
+        rank = np.empty(len(vocabulary), dtype=np.int64)
+        rank[np.argsort(frequency, kind='stable')] = np.arange(len(vocabulary))
+        self.n_tokens = len(vocabulary)
+        (self.l_indptr, l_tokens, self.l_missing), (self.r_indptr, r_tokens, self.r_missing) = tables
+        self.l_ranks = self._sort_records(self.l_indptr, rank[l_tokens])
+        self.r_ranks = self.l_ranks if self.self_join else self._sort_records(self.r_indptr, rank[r_tokens])
+        self._matrices = None
+
+    @staticmethod
+    def _sort_records(indptr, ranks):
+        records = np.repeat(np.arange(indptr.shape[0] - 1), np.diff(indptr))
+        return ranks[np.lexsort((ranks, records))]
+
+    @staticmethod
+    def _prefix(indptr, ranks, overlap_size):
+        """(record, rank) of the prefix tokens of every record with at least overlap_size tokens."""
+        sizes = np.diff(indptr)
+        records = np.repeat(np.arange(sizes.shape[0]), sizes)
+        position = np.arange(ranks.shape[0]) - indptr[records]
+        keep = position < (sizes - overlap_size + 1)[records]
+        return records[keep], ranks[keep]
+
+    @staticmethod
+    def _chunks(records, counts, chunk_size):
+        """(start, stop) ranges of prefix entries with about chunk_size index hits, ending on record boundaries."""
+        #Entries are grouped by record, so a pair found in one chunk never shows up in another
+        total = np.cumsum(counts)
+        start = 0
+        while start < records.shape[0]:
+            done = total[start - 1] if start else 0
+            stop = max(np.searchsorted(total, done + chunk_size, 'right'), start + 1)
+            stop = np.searchsorted(records, records[stop - 1], 'right')
+            yield start, stop
+            start = stop
+
+    def _matrix(self, indptr, ranks):
+        return csr_matrix((np.ones(ranks.shape[0], dtype=np.float32), ranks, indptr),
+                          shape=(indptr.shape[0] - 1, self.n_tokens))
+
+    def max_tokens(self):
+        return int(max(np.diff(self.l_indptr).max(initial=0), np.diff(self.r_indptr).max(initial=0)))
+
+    def overlap(self, l_idx, r_idx, chunk_size=1000000):
+        """Number of shared tokens of the pairs (l_idx[k], r_idx[k]); pairs with a missing value get -1."""
+        l_idx, r_idx = np.asarray(l_idx), np.asarray(r_idx)
+        if self._matrices is None:
+            l_matrix = self._matrix(self.l_indptr, self.l_ranks)
+            self._matrices = l_matrix, l_matrix if self.self_join else self._matrix(self.r_indptr, self.r_ranks)
+        l_matrix, r_matrix = self._matrices
+        sizes = np.zeros(l_idx.shape[0], dtype=np.int64)
+        for start in range(0, l_idx.shape[0], chunk_size):
+            stop = start + chunk_size
+            products = l_matrix[l_idx[start:stop]].multiply(r_matrix[r_idx[start:stop]])
+            sizes[start:stop] = np.asarray(products.sum(axis=1)).ravel()
+        sizes[self.l_missing[l_idx] | self.r_missing[r_idx]] = -1
+        return sizes
+
+    def candidates(self, overlap_size=1, allow_missing=False, chunk_size=1000000, max_candidates=None, symmetric=None):
+        """
+        (l_idx, r_idx) row positions of the pairs sharing at least
+        overlap_size tokens, sorted. Returns None as soon as there are more
+        than max_candidates pairs (if given). symmetric (by default for a
+        self-join) keeps only the pairs l_idx < r_idx: each unordered pair
+        once and no record paired with itself.
+        """
+        if symmetric is None:
+            symmetric = self.self_join
+        l_records, l_prefix = self._prefix(self.l_indptr, self.l_ranks, overlap_size)
+        r_records, r_prefix = self._prefix(self.r_indptr, self.r_ranks, overlap_size)
+        order = np.argsort(r_prefix, kind='stable')
+        r_records, r_prefix = r_records[order], r_prefix[order]
+        lo = np.searchsorted(r_prefix, l_prefix, 'left')
+        hi = np.searchsorted(r_prefix, l_prefix, 'right')
+        n_left, n_right = self.l_indptr.shape[0] - 1, self.r_indptr.shape[0] - 1
+        if n_left == 0 or n_right == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys = []
+        for start, stop in self._chunks(l_records, hi - lo, chunk_size):
+            l_chunk = np.repeat(l_records[start:stop], hi[start:stop] - lo[start:stop])
+            r_chunk = r_records[_expand_ranges(lo[start:stop], hi[start:stop])]
+            chunk_keys = np.unique(l_chunk * n_right + r_chunk)
+            if symmetric:
+                chunk_keys = chunk_keys[chunk_keys // n_right < chunk_keys % n_right]
+            if overlap_size > 1:
+                chunk_keys = chunk_keys[self.overlap(chunk_keys // n_right, chunk_keys % n_right) >= overlap_size]
+            keys.append(chunk_keys)
+            if max_candidates is not None and sum(len(chunk) for chunk in keys) > max_candidates:
+                return None
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+        if allow_missing:
+            #As em.OverlapBlocker: a record with a missing value is paired with every record of the other table
+            l_missing, r_missing = np.flatnonzero(self.l_missing), np.flatnonzero(self.r_missing)
+            keys = np.unique(np.concatenate((keys, (l_missing[:, None] * n_right + np.arange(n_right)).ravel(),
+                                             (np.arange(n_left)[:, None] * n_right + r_missing).ravel())))
+            if symmetric:
+                keys = keys[keys // n_right < keys % n_right]
+            if max_candidates is not None and len(keys) > max_candidates:
+                return None
+        return keys // n_right, keys % n_right
+
+
+def _candset_frame(A, B, l_idx, r_idx, l_output_attrs=None, r_output_attrs=None):
+    """Magellan candset (_id, ltable_id, rtable_id, ltable_<attr>..., rtable_<attr>...) of the given row positions."""
+    C = pd.DataFrame({'_id': np.arange(len(l_idx)), 'ltable_id': A['id'].values[l_idx], 'rtable_id': B['id'].values[r_idx]})
+    for prefix, table, idx, attrs in (('ltable_', A, l_idx, l_output_attrs), ('rtable_', B, r_idx, r_output_attrs)):
+        for attr in attrs or []:
+            if attr != 'id':
+                C[prefix + attr] = table[attr].values[idx]
+    em.set_key(C, '_id')
+    em.set_property(C, 'ltable', A)
+    em.set_property(C, 'rtable', B)
+    em.set_property(C, 'fk_ltable', 'ltable_id')
+    em.set_property(C, 'fk_rtable', 'rtable_id')
+    return C
 
 
+def overlap_block_tables(A, B, l_overlap_attr, r_overlap_attr, word_level=True, q_val=None, overlap_size=1,
+                         l_output_attrs=None, r_output_attrs=None, allow_missing=False, rem_stop_words=False):
+    """
+    Drop-in replacement for em.OverlapBlocker().block_tables: pairs whose
+    overlap attributes share at least overlap_size words (or q-grams),
+    found through an inverted index with prefix filtering instead of an
+    overlap join over all token pairs. Blocking a table with itself
+    (A is B) yields every unordered pair once, without self pairs.
+    """
+    index = OverlapIndex(A, B, l_overlap_attr, r_overlap_attr, word_level, q_val, rem_stop_words)
+    l_idx, r_idx = index.candidates(overlap_size, allow_missing)
+    return _candset_frame(A, B, l_idx, r_idx, l_output_attrs, r_output_attrs)
+
+
+#Probability with which the LSH bands find a pair right at the verification threshold
+LSH_TARGET_RECALL = 0.95
+
+
+class MinHashIndex:
+    """
+    MinHash signatures (num_perm universal hashes) of the token sets of an
+    OverlapIndex, for banded LSH: pairs agreeing on all rows_per_band
+    values of at least one of num_bands bands become candidates, so a pair
+    with Jaccard similarity s is found with probability
+    1 - (1 - s^rows_per_band)^num_bands.
+    """
+    _prime = (1 << 31) - 1
+
+    def __init__(self, index, num_perm=128, seed=0):
+        self.index = index
+        self.num_perm = num_perm
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, self._prime, num_perm).astype(np.int64)
+        self._b = rng.randint(0, self._prime, num_perm).astype(np.int64)
+        self.l_signatures = self._signatures(index.l_indptr, index.l_ranks)
+        self.r_signatures = self.l_signatures if index.self_join else self._signatures(index.r_indptr, index.r_ranks)
+
+    def _signatures(self, indptr, ranks, perm_block=16):
+        sizes = np.diff(indptr)
+        nonempty = np.flatnonzero(sizes)
+        #Records without tokens keep the sentinel and are never bucketed
+        signatures = np.full((sizes.shape[0], self.num_perm), self._prime, dtype=np.int64)
+        for start in range(0, self.num_perm, perm_block):
+            stop = min(start + perm_block, self.num_perm)
+            hashes = (ranks[:, None] * self._a[start:stop] + self._b[start:stop]) % self._prime
+            if nonempty.shape[0]:
+                signatures[nonempty, start:stop] = np.minimum.reduceat(hashes, indptr[nonempty], axis=0)
+        return signatures
+
+    @staticmethod
+    def band_parameters(threshold, num_perm=128, target_recall=LSH_TARGET_RECALL):
+        """
+        (num_bands, rows_per_band) with the most rows per band (fewest
+        chance collisions) that still finds a pair of Jaccard similarity
+        threshold with probability target_recall. Centring the S-curve
+        (1/b)^(1/r) on threshold instead would find such pairs only about
+        half the time, so the band threshold sits below the verification
+        threshold: a higher target_recall keeps more pairs near threshold at
+        the cost of more colliding pairs to verify.
+        """
+        options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+        recall = lambda option: 1.0 - (1.0 - threshold ** option[1]) ** option[0]
+        #One row per band (every shared MinHash value) has the highest recall, if no option reaches target_recall
+        feasible = [option for option in options if recall(option) >= target_recall] or options[:1]
+        return max(feasible, key=lambda option: option[1])
+
+    def candidates(self, threshold=None, num_bands=None, rows_per_band=None, max_candidates=None, symmetric=None,
+                   target_recall=LSH_TARGET_RECALL):
+        """
+        (l_idx, r_idx) of the pairs colliding in a band, sorted. With a
+        threshold the pairs are verified to have a token Jaccard similarity
+        of at least threshold, and the bands default to band_parameters
+        (a pair at threshold is found with probability target_recall).
+        Returns None as soon as there are more than max_candidates pairs.
+        symmetric is as in OverlapIndex.candidates.
+        """
+        if symmetric is None:
+            symmetric = self.index.self_join
+        if num_bands is None or rows_per_band is None:
+            num_bands, rows_per_band = self.band_parameters(0.5 if threshold is None else threshold, self.num_perm,
+                                                            target_recall)
+        index = self.index
+        n_right = index.r_indptr.shape[0] - 1
+        l_sizes, r_sizes = np.diff(index.l_indptr), np.diff(index.r_indptr)
+        l_valid, r_valid = np.flatnonzero(l_sizes), np.flatnonzero(r_sizes)
+        if threshold is not None:
+            l_matrix, r_matrix = index._matrix(index.l_indptr, index.l_ranks), index._matrix(index.r_indptr, index.r_ranks)
+        #A band is hashed to one uint64 (wrapping arithmetic), collisions of different bands are negligible
+        multipliers = np.random.RandomState(seed=1).randint(1, 1 << 62, rows_per_band).astype(np.uint64) | np.uint64(1)
+        l_signatures = self.l_signatures[l_valid].astype(np.uint64)
+        r_signatures = self.r_signatures[r_valid].astype(np.uint64)
+        keys = np.zeros(0, dtype=np.int64)
+        for band in range(num_bands):
+            rows = slice(band * rows_per_band, (band + 1) * rows_per_band)
+            l_keys = (l_signatures[:, rows] * multipliers).sum(axis=1, dtype=np.uint64)
+            r_keys = (r_signatures[:, rows] * multipliers).sum(axis=1, dtype=np.uint64)
+            order = np.argsort(r_keys, kind='stable')
+            r_keys, r_records = r_keys[order], r_valid[order]
+            lo, hi = np.searchsorted(r_keys, l_keys, 'left'), np.searchsorted(r_keys, l_keys, 'right')
+            band_keys = np.repeat(l_valid, hi - lo) * n_right + r_records[_expand_ranges(lo, hi)]
+            if symmetric:
+                band_keys = band_keys[band_keys // n_right < band_keys % n_right]
+            band_keys = np.setdiff1d(band_keys, keys)
+            if threshold is not None and band_keys.shape[0]:
+                l_idx, r_idx = band_keys // n_right, band_keys % n_right
+                inter = np.asarray(l_matrix[l_idx].multiply(r_matrix[r_idx]).sum(axis=1)).ravel()
+                band_keys = band_keys[inter >= threshold * (l_sizes[l_idx] + r_sizes[r_idx] - inter)]
+            keys = np.union1d(keys, band_keys)
+            if max_candidates is not None and keys.shape[0] > max_candidates:
+                return None
+        return keys // n_right, keys % n_right
+
+
+def lsh_block_tables(A, B, l_overlap_attr, r_overlap_attr, threshold=0.5, num_bands=None, rows_per_band=None,
+                     word_level=True, q_val=None, num_perm=128, l_output_attrs=None, r_output_attrs=None,
+                     rem_stop_words=False, seed=0, target_recall=LSH_TARGET_RECALL):
+    """
+    MinHash/LSH blocking: pairs whose token sets (cleaned as in
+    overlap_block_tables) collide in an LSH band and have a Jaccard
+    similarity of at least threshold (threshold=None keeps every
+    collision). Lowering threshold (or choosing more bands / fewer rows per
+    band) trades candset size for recall in finer steps than overlap_size.
+    Pairs at threshold are found with probability target_recall (higher
+    above it); raising it costs more collisions to verify.
+    """
+    index = OverlapIndex(A, B, l_overlap_attr, r_overlap_attr, word_level, q_val, rem_stop_words)
+    l_idx, r_idx = MinHashIndex(index, num_perm, seed).candidates(threshold, num_bands, rows_per_band,
+                                                                  target_recall=target_recall)
+    return _candset_frame(A, B, l_idx, r_idx, l_output_attrs, r_output_attrs)
+
+
+@per_pair_blocker
 def blocking_for_citeseer_dblp(A,B):
     #A = em.read_csv_metadata("citeseer_sample.csv", key="id", encoding='utf-8')
     #B = em.read_csv_metadata("dblp_sample.csv", key="id", encoding='utf-8')
     attributes = ['id', 'title', 'authors', 'journal', 'month', 'year', 'publication_type']
 
-    ob = em.OverlapBlocker()
-    C1 = ob.block_tables(A, B, 'title', 'title', word_level=True, overlap_size=2, show_progress=True,
+    C1 = overlap_block_tables(A, B, 'title', 'title', word_level=True, overlap_size=2,
                          l_output_attrs=attributes, r_output_attrs=attributes)
     return C1
     #verify_blocking_ground_truth(A, B, C1, matches_df_head)
 
 #fodors.csv and zagats.csv
+@per_pair_blocker
 def block_fodors_zagats(A, B):
-    ob = em.OverlapBlocker()
-    C = ob.block_tables(A, B, 'name', 'name', l_output_attrs=['name', 'addr', 'city', 'phone'],  r_output_attrs=['name', 'addr', 'city', 'phone'],
-        overlap_size=1, show_progress=False)
+    C = overlap_block_tables(A, B, 'name', 'name', l_output_attrs=['name', 'addr', 'city', 'phone'],  r_output_attrs=['name', 'addr', 'city', 'phone'],
+        overlap_size=1)
     return C
 
 
 #babies_r_us.csv and buy_buy_baby.csv
+@per_pair_blocker
 def block_baby_products(A, B):
-    ob = em.OverlapBlocker()
     # attributes = ['title', 'price', 'category', 'company_struct', 'brand', 'weight', 'length', 'width', 'height', 'fabrics', 'colors', 'materials']
     attributes = ['title', 'price', 'is_discounted', 'category', 'company_struct']
     # C = ob.block_tables(A, B, 'title', 'title', l_output_attrs=attributes,  r_output_attrs=attributes,
     #     overlap_size=3, show_progress=False)
-    C = ob.block_tables(A, B, 'title', 'title', word_level = True, overlap_size = 4, show_progress = True, l_output_attrs = attributes, r_output_attrs = attributes)
+    C = overlap_block_tables(A, B, 'title', 'title', word_level = True, overlap_size = 4, l_output_attrs = attributes, r_output_attrs = attributes)
     return C
 
 
 #barnes_and_noble.csv and half.csv
+@per_pair_blocker
 def block_books(A, B):
     #assumes some preprocessing is done:
     #Specifically in half.csv : NewPrice  => Price
 
-    ob = em.OverlapBlocker()
     # attributes = ['Title', 'Price', 'Author', 'ISBN13', 'Publisher', 'Publication_Date', 'Pages', 'Dimensions']
     attributes = ['Title', 'Author', 'ISBN13', 'Publisher', 'Publication_Date', 'Pages', 'Dimensions']
     # C = ob.block_tables(A, B, 'Title', 'Title', l_output_attrs=attributes,  r_output_attrs=attributes,
     #     overlap_size=1, show_progress=False)
-    C = ob.block_tables(A, B, 'Title', 'Title', word_level=True, overlap_size=4, show_progress=True,
+    C = overlap_block_tables(A, B, 'Title', 'Title', word_level=True, overlap_size=4,
                         l_output_attrs=attributes, r_output_attrs=attributes)
     return C
 
 
 #yellow_pages.csv and yelp.csv
+@per_pair_blocker
 def block_restaurants(A, B):
     #assumes some preprocessing is done:
     #Specifically in half.csv : NewPrice  => Price
 
-    ob = em.OverlapBlocker()
     attributes = ['name', 'address', 'city', 'state', 'zipcode', 'phone']
     # C = ob.block_tables(A, B, 'name', 'name', l_output_attrs=attributes,  r_output_attrs=attributes,
     #     overlap_size=1, show_progress=False)
-    C = ob.block_tables(A, B, 'name', 'name', word_level=True, overlap_size=4, show_progress=True,
+    C = overlap_block_tables(A, B, 'name', 'name', word_level=True, overlap_size=4,
                         l_output_attrs=attributes, r_output_attrs=attributes)
     return C
 
 
 #dblp.csv and ACM.csv
+@per_pair_blocker
 def block_dblp_acm(A, B):
     ab = em.AttrEquivalenceBlocker()
     C = ab.block_tables(A, B, l_block_attr='year', r_block_attr='year', l_output_attrs=["title","authors","venue","year"],
@@ -107,65 +419,66 @@ def block_dblp_acm(A, B):
 
 
 #dblp.csv and google_scholar.csv
+@per_pair_blocker
 def block_dblp_scholar(A, B):
-    ob = em.OverlapBlocker()
     attributes = ["id","title","authors","venue","year"]
     #C1 = ob.block_tables(A, B, 'title', 'title', word_level=True, overlap_size=3, show_progress=True, l_output_attrs=attributes, r_output_attrs=attributes)
     #=================>results in a candidate set of size 1.2M with 178 missing duplicates out of 5347
-    C2 = ob.block_tables(A, B, 'title', 'title', word_level=True, overlap_size=4, show_progress=True, l_output_attrs=attributes, r_output_attrs=attributes)
+    C2 = overlap_block_tables(A, B, 'title', 'title', word_level=True, overlap_size=4, l_output_attrs=attributes, r_output_attrs=attributes)
     #=================>results in a candidate set of size 135K with 467 missing duplicates out of 5347
     return C2
 
+@per_pair_blocker
 def block_rotten_imdb(A, B):
-    ob = em.OverlapBlocker()
     attributes = set(A.columns)
     attributes.remove("id")
     attributes = list(attributes.intersection(set(B.columns)))
     #C1 = ob.block_tables(A, B, 'title', 'title', word_level=True, overlap_size=3, show_progress=True, l_output_attrs=attributes, r_output_attrs=attributes)
     #=================>results in a candidate set of size 1.2M with 178 missing duplicates out of 5347
-    C2 = ob.block_tables(A, B, 'Name', 'Name', word_level=True, overlap_size=2, show_progress=True, l_output_attrs=attributes, r_output_attrs=attributes)
+    C2 = overlap_block_tables(A, B, 'Name', 'Name', word_level=True, overlap_size=2, l_output_attrs=attributes, r_output_attrs=attributes)
     #=================>results in a candidate set of size 135K with 467 missing duplicates out of 5347
     return C2
 
 
+def _append_manufacturer(table_df):
+    #The manufacturer is part of the description of the Buy table (abt.csv has no manufacturer column)
+    if "description" in table_df.columns and "manufacturer" in table_df.columns:
+        table_df["description"] = table_df["description"] + " " + table_df["manufacturer"]
+
+
 #abt.csv and buy.csv
+@per_pair_blocker
+@table_preprocessor(_append_manufacturer)
 def block_abt_buy(A, B):
-    try:
-        B["description"] = B["description"] + " " + B["manufacturer"]
-    except:
-        print()
-    ob = em.OverlapBlocker()
     #=================>results in a candidate set of size 164K with 6 missing duplicates out of 1097
-    C = ob.block_tables(A, B, "name", "name", word_level=True, overlap_size=1,
-    l_output_attrs=["name","description","price"], r_output_attrs=["name","description","price"], show_progress=True, allow_missing=False)
+    C = overlap_block_tables(A, B, "name", "name", word_level=True, overlap_size=1,
+    l_output_attrs=["name","description","price"], r_output_attrs=["name","description","price"], allow_missing=False)
     return C
 
 
 #walmart.csv and amazon.csv
+@per_pair_blocker
 def block_walmart_amazon_(A, B):
     #assumes some preprocessing is done:
     #Specifically in amazon.csv : a.    pcategory2  => groupname , b.    { proddescrshort,proddescrlong } => shortdescr,longdescr
 
-    ob = em.OverlapBlocker()
-
     #C1 = ob.block_tables(ltable, rtable, 'title', 'title', word_level=True, overlap_size=2)
     #=================>results in a candidate set of size 1.1M with 20 missing duplicates out of 1154
     #blocking_utils.verify_blocking_ground_truth(dataset_name, C1)
 
     attributes = ['brand', 'groupname', 'title', 'price', 'shortdescr', 'longdescr', 'imageurl', 'modelno', 'shipweight', 'dimensions']
-    C2 = ob.block_tables(A, B, 'title', 'title', word_level=True, overlap_size=3, l_output_attrs=attributes, r_output_attrs=attributes, show_progress=True, allow_missing=True)
+    C2 = overlap_block_tables(A, B, 'title', 'title', word_level=True, overlap_size=3, l_output_attrs=attributes, r_output_attrs=attributes, allow_missing=True)
     #=================>results in a candidate set of size 278K with 84 missing duplicates out of 1154
     #blocking_utils.verify_blocking_ground_truth(dataset_name, C2)
 
     return C2
 
 #walmart.csv and amazon.csv
+@per_pair_blocker
 def block_walmart_amazon(A, B):
     #assumes some preprocessing is done:
     #Specifically in amazon.csv : a.    pcategory2  => groupname , b.    { proddescrshort,proddescrlong } => shortdescr,longdescr
 
-    ob = em.OverlapBlocker()
-
     #C1 = ob.block_tables(ltable, rtable, 'title', 'title', word_level=True, overlap_size=2)
     #=================>results in a candidate set of size 1.1M with 20 missing duplicates out of 1154
     #blocking_utils.verify_blocking_ground_truth(dataset_name, C1)
@@ -188,17 +501,16 @@ def block_walmart_amazon(A, B):
             l_attributes = r_attributes
     
     #attributes = ['brand', 'groupname', 'title', 'price', 'shortdescr', 'longdescr', 'imageurl', 'modelno', 'shipweight', 'dimensions']
-    C2 = ob.block_tables(A, B, 'title', 'title', word_level=True, overlap_size=2, l_output_attrs=l_attributes, r_output_attrs=r_attributes, show_progress=True, allow_missing=True)
+    C2 = overlap_block_tables(A, B, 'title', 'title', word_level=True, overlap_size=2, l_output_attrs=l_attributes, r_output_attrs=r_attributes, allow_missing=True)
     #=================>results in a candidate set of size 278K with 84 missing duplicates out of 1154
     #blocking_utils.verify_blocking_ground_truth(dataset_name, C2)
     return C2
 
+@per_pair_blocker
 def block_wa(A, B):
     #assumes some preprocessing is done:
     #Specifically in amazon.csv : a.    pcategory2  => groupname , b.    { proddescrshort,proddescrlong } => shortdescr,longdescr
 
-    ob = em.OverlapBlocker()
-
     #C1 = ob.block_tables(ltable, rtable, 'title', 'title', word_level=True, overlap_size=2)
     #=================>results in a candidate set of size 1.1M with 20 missing duplicates out of 1154
     #blocking_utils.verify_blocking_ground_truth(dataset_name, C1)
@@ -211,14 +523,14 @@ def block_wa(A, B):
     if not set(l_attributes).issubset(A.columns):
         l_attributes = r_attributes
     #attributes = ['brand', 'groupname', 'title', 'price', 'shortdescr', 'longdescr', 'imageurl', 'modelno', 'shipweight', 'dimensions']
-    C2 = ob.block_tables(A, B, 'title', 'title', word_level=True, overlap_size=2, l_output_attrs=l_attributes, r_output_attrs=r_attributes, show_progress=True, allow_missing=True)
+    C2 = overlap_block_tables(A, B, 'title', 'title', word_level=True, overlap_size=2, l_output_attrs=l_attributes, r_output_attrs=r_attributes, allow_missing=True)
     #=================>results in a candidate set of size 278K with 84 missing duplicates out of 1154
     #blocking_utils.verify_blocking_ground_truth(dataset_name, C2)
     return C2
 
 #amazon.csv and GoogleProducts.csv
+@per_pair_blocker
 def block_amazon_googleproducts(A, B):
-    ob = em.OverlapBlocker()
     # Note: tableA has "title" column, tableB has "name" column
     # Using overlap_size=1 for maximum recall (original setting)
     # Produces ~400K candidates with 6 missing duplicates out of 1300
@@ -229,25 +541,21 @@ def block_amazon_googleproducts(A, B):
     # Filter to only include columns that exist
     l_output_attrs = [col for col in l_output_attrs if col in A.columns]
     r_output_attrs = [col for col in r_output_attrs if col in B.columns]
-    # Get n_jobs from environment variable if set, otherwise use default
-    n_jobs = get_n_jobs()
-    C = ob.block_tables(A, B, l_attr, r_attr, word_level=True, overlap_size=1, 
-                        l_output_attrs=l_output_attrs, r_output_attrs=r_output_attrs, 
-                        show_progress=True, allow_missing=False, n_jobs=n_jobs)
+    C = overlap_block_tables(A, B, l_attr, r_attr, word_level=True, overlap_size=1, 
+                        l_output_attrs=l_output_attrs, r_output_attrs=r_output_attrs, allow_missing=False)
     return C
 
+@per_pair_blocker
 def block_songs(A, B):
-    ob = em.OverlapBlocker()
     #=================>results in a candidate set of size 400K with 6 missing duplicates out of 1300
-    C = ob.block_tables(A, B, "title", "title", word_level=True, overlap_size=1,
+    C = overlap_block_tables(A, B, "title", "title", word_level=True, overlap_size=1,
                         l_output_attrs=["title","release","artist_name","duration","artist_familiarity","artist_hotttnesss","year"],
-                        r_output_attrs=["title","release","artist_name","duration","artist_familiarity","artist_hotttnesss","year"],
-                        show_progress=True, allow_missing=False,n_jobs=8)
+                        r_output_attrs=["title","release","artist_name","duration","artist_familiarity","artist_hotttnesss","year"], allow_missing=False)
     return C
 
 #Beer dataset: tableA.csv and tableB.csv
+@per_pair_blocker
 def block_beer(A, B):
-    ob = em.OverlapBlocker()
     # Use Beer_Name as the blocking key, similar to other product datasets
     # Attributes: Beer_Name, Brew_Factory_Name, Style, ABV
     # Using overlap_size=3 for better precision (stricter blocking to reduce false positives)
@@ -257,12 +565,12 @@ def block_beer(A, B):
     # Filter to only include columns that exist
     l_output_attrs = [col for col in attributes if col in A.columns]
     r_output_attrs = [col for col in attributes if col in B.columns]
-    C = ob.block_tables(A, B, 'Beer_Name', 'Beer_Name', word_level=True, overlap_size=3,
-                        l_output_attrs=l_output_attrs, r_output_attrs=r_output_attrs,
-                        show_progress=True, allow_missing=True)
+    C = overlap_block_tables(A, B, 'Beer_Name', 'Beer_Name', word_level=True, overlap_size=3,
+                        l_output_attrs=l_output_attrs, r_output_attrs=r_output_attrs, allow_missing=True)
     return C
 
-def generic_blocking_func(A, B):
+@per_pair_blocker
+def cartesian_blocking_func(A, B):
     A_prefix = A.add_prefix('ltable_')
     B_prefix = B.add_prefix('rtable_')
     A_prefix['key'] = 1
@@ -274,6 +582,89 @@ def generic_blocking_func(A, B):
     print (list(final))
     return final
 
+
+#Candidate budget of generic_blocking_func; tables with at most this many pairs are not blocked at all
+GENERIC_MAX_CANDIDATES = 2000000
+
+
+def pick_blocking_attribute(A, B, sample_size=10000, max_words=50):
+    """
+    Text attribute shared by A and B that identifies records best: the
+    highest fraction of non-missing, distinct values in a sample, among
+    attributes that are not long free text (at most max_words words on average).
+    """
+    best, best_score = None, -1.0
+    for attr in A.columns:
+        if attr == 'id' or attr not in B.columns or A[attr].dtype != object or B[attr].dtype != object:
+            continue
+        score = 1.0
+        for table in (A, B):
+            values = table[attr].iloc[:sample_size]
+            present = values.dropna().astype(str)
+            if len(present) == 0 or present.str.split().str.len().mean() > max_words:
+                score = 0.0
+                break
+            score *= len(present) / len(values) * present.nunique() / len(present)
+        if score > best_score:
+            best, best_score = attr, score
+    if best is None or best_score <= 0:
+        raise ValueError("No text attribute shared by both tables to block on")
+    return best
+
+
+def generic_blocking_func(A, B, attr=None, max_candidates=GENERIC_MAX_CANDIDATES, method="overlap"):
+    """
+    Blocking for datasets without a dedicated blocking function. Tables
+    with at most max_candidates pairs are returned as the full cross
+    product; otherwise records are blocked on attr (by default
+    pick_blocking_attribute) with the loosest setting whose candset fits in
+    max_candidates: the smallest word overlap size (method="overlap") or
+    the lowest Jaccard threshold of MinHash/LSH blocking (method="lsh").
+    """
+    if len(A) * len(B) <= max_candidates:
+        if A is B:
+            return _candset_frame(A, B, *np.triu_indices(len(A), 1))
+        l_idx, r_idx = np.divmod(np.arange(len(A) * len(B)), len(B))
+        return _candset_frame(A, B, l_idx, r_idx)
+    if attr is None:
+        attr = pick_blocking_attribute(A, B)
+    index = OverlapIndex(A, B, attr, attr)
+    if method == "lsh":
+        minhash = MinHashIndex(index)
+        settings = [("threshold=%.1f" % threshold, functools.partial(minhash.candidates, threshold))
+                    for threshold in np.arange(1, 10) / 10.0]
+    else:
+        settings = [("overlap_size=%d" % overlap_size, functools.partial(index.candidates, overlap_size))
+                    for overlap_size in range(1, max(index.max_tokens(), 1) + 1)]
+    for setting, candidates_fn in settings:
+        #Candidates are counted as they are generated and dropped as soon as they exceed the budget
+        candidates = candidates_fn(max_candidates=max_candidates)
+        if candidates is not None:
+            break
+    if candidates is None:
+        print(f"[BLOCKING] No {method} setting on {attr} fits {max_candidates:,} candidates, using {setting}")
+        candidates = candidates_fn()
+    l_idx, r_idx = candidates
+    print(f"[BLOCKING] generic {method} blocking on {attr} with {setting}: {len(l_idx):,} candidates")
+    return _candset_frame(A, B, l_idx, r_idx)
+
+
+#LSH variants of the blockers above: a Jaccard threshold instead of an integer overlap size
+def block_amazon_googleproducts_lsh(A, B, threshold=0.2):
+    l_attr = "title" if "title" in A.columns else "name"
+    r_attr = "name" if "name" in B.columns else "title"
+    #=================>results in a candidate set of size 14K with 91% of the duplicates (overlap_size=1: 358K, 99.5%)
+    return lsh_block_tables(A, B, l_attr, r_attr, threshold=threshold)
+
+
+def block_beer_lsh(A, B, threshold=0.4):
+    #=================>results in a candidate set of size 36K with 91% of the duplicates
+    return lsh_block_tables(A, B, 'Beer_Name', 'Beer_Name', threshold=threshold)
+
+
+def block_dblp_scholar_lsh(A, B, threshold=0.5):
+    return lsh_block_tables(A, B, 'title', 'title', threshold=threshold)
+
 blocking_functions_mapping = defaultdict(str)
 blocking_functions_mapping["fodors_zagats"] = block_fodors_zagats
 blocking_functions_mapping["fodors_zagats_single"] = block_fodors_zagats
@@ -299,4 +690,10 @@ blocking_functions_mapping["books"] = block_books
 blocking_functions_mapping["baby_products"] = block_baby_products
 blocking_functions_mapping["restaurants"] = block_restaurants
 blocking_functions_mapping['wa'] = block_wa
-blocking_functions_mapping["beer"] = block_beer
\ No newline at end of file
+blocking_functions_mapping["beer"] = block_beer
+
+#Not datasets: select with zeroer.py --blocking_func
+blocking_functions_mapping["amazon_googleproducts_lsh"] = block_amazon_googleproducts_lsh
+blocking_functions_mapping["beer_lsh"] = block_beer_lsh
+blocking_functions_mapping["dblp_scholar_lsh"] = block_dblp_scholar_lsh
+blocking_functions_mapping["generic_lsh"] = functools.partial(generic_blocking_func, method="lsh")
@@ -0,0 +1,182 @@
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+
+""" Quality and cost of a blocking run. Candidate and match pairs are
+compared as sets of exact int64 keys of the (ltable_id, rtable_id) pairs,
+so pair completeness is one np.isin over two integer arrays instead of a
+merge of the candset with the ground truth. Every stage records its wall
+time and the peak resident memory reached while it ran.
+"""
+
+
+def _as_numbers(ids):
+    """ids as a numeric array, or None if some id is not a number."""
+    if ids.dtype.kind in "iuf":
+        return ids
+    numbers = pd.to_numeric(ids, errors="coerce")
+    if np.isnan(numbers.astype(np.float64)).any():
+        return None
+    return numbers
+
+
+def _as_strings(ids):
+    """ids as strings; whole floats (ids of a column with gaps) lose the ".0"."""
+    if ids.dtype.kind == "f" and np.isfinite(ids).all() and (ids == np.floor(ids)).all():
+        ids = ids.astype(np.int64)
+    if ids.dtype == object and pd.api.types.infer_dtype(ids, skipna=False) == "string":
+        return ids
+    return ids.astype(str).astype(object)
+
+
+def _normalize_ids(match_ids, table_ids):
+    """
+    Ids of a matches file and of a table (or candset) in one
+    representation: as numbers when both sides are numbers or numeric
+    strings (7, 7.0, "7" and "007" agree, whether the tables and the matches
+    were read as strings or not), as strings otherwise.
+    """
+    match_ids, table_ids = np.asarray(match_ids), np.asarray(table_ids)
+    if match_ids.dtype == table_ids.dtype and match_ids.dtype.kind in "iu":
+        return match_ids, table_ids
+    match_numbers = _as_numbers(match_ids)
+    table_numbers = _as_numbers(table_ids) if match_numbers is not None else None
+    if table_numbers is not None:
+        return match_numbers, table_numbers
+    return _as_strings(match_ids), _as_strings(table_ids)
+
+
+def _id_codes(table_ids, match_ids):
+    """
+    int64 codes of the table (or candset) ids and of the match ids from one
+    factorization, equal for ids that _normalize_ids makes equal. Only the
+    distinct ids of each side are normalized.
+    """
+    table_codes, table_uniques = pd.factorize(np.asarray(table_ids), use_na_sentinel=False)
+    match_codes, match_uniques = pd.factorize(np.asarray(match_ids), use_na_sentinel=False)
+    match_uniques, table_uniques = _normalize_ids(match_uniques, table_uniques)
+    codes, _ = pd.factorize(np.concatenate((table_uniques, match_uniques)), use_na_sentinel=False)
+    codes = codes.astype(np.int64)
+    return codes[:len(table_uniques)][table_codes], codes[len(table_uniques):][match_codes]
+
+
+def pair_keys(ltable_ids, rtable_ids, matches_df):
+    """
+    int64 keys of the (ltable_id, rtable_id) pairs and of the match pairs
+    (first two columns of matches_df): the left id code in the high and
+    the right id code in the low 32 bits, as model._pair_keys packs them
+    but keeping the orientation. Equal keys are equal id pairs; ids are
+    compared after _normalize_ids.
+    """
+    l_codes, l_match_codes = _id_codes(ltable_ids, matches_df.iloc[:, 0].values)
+    r_codes, r_match_codes = _id_codes(rtable_ids, matches_df.iloc[:, 1].values)
+    return (l_codes << 32) | r_codes, (l_match_codes << 32) | r_match_codes
+
+
+def is_match(ltable_ids, rtable_ids, matches_df):
+    """Boolean array of which (ltable_id, rtable_id) pairs are match pairs (first two columns of matches_df)."""
+    candidate_keys, match_keys = pair_keys(ltable_ids, rtable_ids, matches_df)
+    return np.isin(candidate_keys, match_keys)
+
+
+def pair_completeness(candset, matches_df):
+    """
+    (pair completeness, #matches found, #matches) of a CandidateSet against
+    the match pairs in the first two columns of matches_df. Duplicate match
+    rows count once; completeness is None without matches.
+    """
+    candidate_keys, match_keys = pair_keys(candset.ltable_ids, candset.rtable_ids, matches_df)
+    match_keys = np.unique(match_keys)
+    found = int(np.isin(match_keys, candidate_keys).sum())
+    completeness = found / len(match_keys) if len(match_keys) else None
+    return completeness, found, len(match_keys)
+
+
+def _reset_peak_rss():
+    #Linux only: writing 5 to clear_refs resets VmHWM, so the peak is per stage
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class BlockingReport:
+    """
+    Collects the stages and candsets of a blocking run and writes them as
+    JSON:
+        {"blocking_fn": ..., "tables": {...}, "matches": ...,
+         "stages": [{"name", "seconds", "peak_rss_mb"}, ...],
+         "candsets": {name: {"candidates", "reduction_ratio",
+                             "pair_completeness", "matches_found", ...}}}
+    peak_rss_mb is the peak of the stage itself where the OS lets the peak
+    be reset (Linux), otherwise the peak of the process so far.
+    """
+
+    def __init__(self, blocking_fn=None):
+        name = getattr(blocking_fn, "__name__", None) or getattr(getattr(blocking_fn, "func", None), "__name__", None)
+        self.report = {"blocking_fn": name, "tables": {}, "matches": None, "stages": [], "candsets": {}}
+
+    @contextmanager
+    def stage(self, name, **info):
+        per_stage = _reset_peak_rss()
+        start = time.time()
+        try:
+            yield
+        finally:
+            record = {"name": name, "seconds": round(time.time() - start, 3),
+                      "peak_rss_mb": round(_peak_rss_mb(), 1), "peak_per_stage": per_stage}
+            record.update(info)
+            self.report["stages"].append(record)
+
+    def add_table(self, side, file_name, table_df):
+        self.report["tables"][side] = {"file": file_name, "records": len(table_df)}
+
+    def add_matches(self, matches_df):
+        self.report["matches"] = None if matches_df is None else len(matches_df)
+
+    def add_candset(self, name, candset, matches_df=None):
+        """Size, reduction ratio and (with matches_df) pair completeness of a CandidateSet."""
+        n_pairs = len(candset.ltable_df) * len(candset.rtable_df)
+        if candset.ltable_df is candset.rtable_df:
+            #Self-join candsets are unordered pairs of distinct records
+            n_pairs = len(candset.ltable_df) * (len(candset.ltable_df) - 1) // 2
+        record = {"candidates": len(candset),
+                  "reduction_ratio": 1.0 - len(candset) / n_pairs if n_pairs else None,
+                  "pair_completeness": None, "matches_found": None, "matches_missed": None}
+        if matches_df is not None:
+            completeness, found, total = pair_completeness(candset, matches_df)
+            record.update(pair_completeness=completeness, matches_found=found, matches_missed=total - found)
+        self.report["candsets"][name] = record
+        return record
+
+    def extend(self, other):
+        """Add the stages and candsets of another BlockingReport (e.g. one made in a worker process)."""
+        other = other.report if isinstance(other, BlockingReport) else other
+        self.report["stages"].extend(other["stages"])
+        self.report["candsets"].update(other["candsets"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report, f, indent=2)
+        print(f"[LOAD_DATA] Blocking report written to {path}", flush=True)
@@ -0,0 +1,115 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+
+class CandidateSet:
+    """
+    Candidate pairs as two int32 arrays of row positions into ltable_df and
+    rtable_df. Record attributes are not copied per pair: ids and output
+    attributes are looked up from the tables when asked for (attribute,
+    to_frame), so a candset costs 8 bytes per pair whatever the blocker
+    output attributes are.
+    """
+
+    def __init__(self, ltable_df, rtable_df, l_idx, r_idx):
+        self.ltable_df = ltable_df
+        self.rtable_df = rtable_df
+        self.l_idx = np.asarray(l_idx, dtype=np.int32)
+        self.r_idx = np.asarray(r_idx, dtype=np.int32)
+
+    @classmethod
+    def from_pairs(cls, ltable_ids, rtable_ids, ltable_df=None, rtable_df=None):
+        """
+        Candidate set of the id pairs (ltable_ids[k], rtable_ids[k]). Without
+        tables the ids are factorized into id-only tables, which is enough
+        for ids and outputs like pred.csv.
+        """
+        ltable_ids, rtable_ids = np.asarray(ltable_ids), np.asarray(rtable_ids)
+        if ltable_df is None:
+            l_idx, l_keys = pd.factorize(ltable_ids)
+            ltable_df = pd.DataFrame({"id": l_keys})
+        else:
+            l_idx = pd.Index(ltable_df["id"].astype(str)).get_indexer(ltable_ids.astype(str))
+        if rtable_df is None:
+            r_idx, r_keys = pd.factorize(rtable_ids)
+            rtable_df = pd.DataFrame({"id": r_keys})
+        else:
+            r_idx = pd.Index(rtable_df["id"].astype(str)).get_indexer(rtable_ids.astype(str))
+        if (l_idx < 0).any() or (r_idx < 0).any():
+            raise KeyError("Candidate set refers to ids that are not in the tables")
+        return cls(ltable_df, rtable_df, l_idx, r_idx)
+
+    @classmethod
+    def from_candset(cls, candset_df, ltable_df=None, rtable_df=None):
+        """Candidate set of a Magellan candset (only ltable_id/rtable_id are used)."""
+        return cls.from_pairs(candset_df["ltable_id"].values, candset_df["rtable_id"].values, ltable_df, rtable_df)
+
+    def __len__(self):
+        return self.l_idx.shape[0]
+
+    @property
+    def ltable_ids(self):
+        return self.ltable_df["id"].values[self.l_idx]
+
+    @property
+    def rtable_ids(self):
+        return self.rtable_df["id"].values[self.r_idx]
+
+    def take(self, rows):
+        """Candidate set of a subset of the pairs (boolean mask or positions)."""
+        return CandidateSet(self.ltable_df, self.rtable_df, self.l_idx[rows], self.r_idx[rows])
+
+    def drop_self_matches(self):
+        return self.take(self.ltable_ids != self.rtable_ids)
+
+    def unordered(self):
+        """
+        Self-join candidate set (ltable_df is rtable_df) with every
+        unordered pair once, as (smaller, larger) row position, and without
+        records paired with themselves.
+        """
+        if self.ltable_df is not self.rtable_df:
+            raise ValueError("Only the pairs of a self-join are unordered")
+        n = len(self.rtable_df)
+        l_idx, r_idx = np.minimum(self.l_idx, self.r_idx), np.maximum(self.l_idx, self.r_idx)
+        keys = np.unique(l_idx.astype(np.int64)[l_idx != r_idx] * n + r_idx[l_idx != r_idx])
+        return CandidateSet(self.ltable_df, self.rtable_df, keys // n, keys % n)
+
+    def attribute(self, column):
+        """Values of a candset column (ltable_id, rtable_<attr>, ...) for every pair."""
+        for prefix, table, idx in (("ltable_", self.ltable_df, self.l_idx), ("rtable_", self.rtable_df, self.r_idx)):
+            if column.startswith(prefix) and column[len(prefix):] in table.columns:
+                return table[column[len(prefix):]].values[idx]
+        raise KeyError(column)
+
+    def to_frame(self, l_output_attrs=(), r_output_attrs=(), **columns):
+        """
+        Candset DataFrame in Magellan's layout (_id, ltable_id, rtable_id,
+        ltable_<attr>..., rtable_<attr>...), followed by the extra columns.
+        """
+        frame = {"_id": np.arange(len(self)), "ltable_id": self.ltable_ids, "rtable_id": self.rtable_ids}
+        for attr in l_output_attrs:
+            frame["ltable_" + attr] = self.attribute("ltable_" + attr)
+        for attr in r_output_attrs:
+            frame["rtable_" + attr] = self.attribute("rtable_" + attr)
+        frame.update(columns)
+        return pd.DataFrame(frame)
+
+
+def per_pair_blocker(blocking_fn):
+    """
+    Mark blocking_fn as deciding every pair from its two records alone, so
+    blocking slices of the tables yields exactly the pairs of those slices
+    (overlap and attribute equivalence blockers with fixed settings).
+    """
+    blocking_fn.per_pair = True
+    return blocking_fn
+
+
+def blocks_per_pair(blocking_fn):
+    """Whether blocking_fn (or the function a functools.partial wraps) is marked with per_pair_blocker."""
+    while isinstance(blocking_fn, functools.partial):
+        blocking_fn = blocking_fn.func
+    return getattr(blocking_fn, "per_pair", False)
@@ -1,17 +1,46 @@
+import functools
 import pandas as pd
 from pandas import merge
 import py_entitymatching as em
 import sys
+from os.path import exists
 
-def load_data(left_file_name, right_file_name, label_file_name, blocking_fn, include_self_join=False):
-    print(f"[LOAD_DATA] Starting data loading...", flush=True)
+from .candidate_set import CandidateSet
+from .feature_cache import cached_blocking
+from .feature_store import feature_store_path
+from .table_loader import read_table
+
+def table_preprocessor(preprocess):
+    """
+    Decorator for a blocking function whose tables need preprocess(table_df)
+    (in place) once after loading. load_tables applies it, so blocking and
+    feature extraction see the same attribute values.
+    """
+    def mark(blocking_fn):
+        blocking_fn.preprocess_table = preprocess
+        return blocking_fn
+    return mark
+
+
+def preprocess_tables(blocking_fn, *tables):
+    """Apply the table_preprocessor of blocking_fn (or the function a functools.partial wraps) to the tables."""
+    while isinstance(blocking_fn, functools.partial):
+        blocking_fn = blocking_fn.func
+    preprocess = getattr(blocking_fn, "preprocess_table", None)
+    if preprocess is not None:
+        for table_df in tables:
+            preprocess(table_df)
+
+
+def load_tables(left_file_name, right_file_name, label_file_name, blocking_fn=None):
     print(f"[LOAD_DATA] Loading left table: {left_file_name}", flush=True)
-    A = em.read_csv_metadata(left_file_name , key="id", encoding='iso-8859-1')
+    A = read_table(left_file_name, key="id", encoding='iso-8859-1')
     print(f"[LOAD_DATA] Left table loaded: {len(A)} rows, columns: {list(A.columns)}", flush=True)
     
     print(f"[LOAD_DATA] Loading right table: {right_file_name}", flush=True)
-    B = em.read_csv_metadata(right_file_name , key="id", encoding='iso-8859-1')
+    B = read_table(right_file_name, key="id", encoding='iso-8859-1')
     print(f"[LOAD_DATA] Right table loaded: {len(B)} rows, columns: {list(B.columns)}", flush=True)
+    preprocess_tables(blocking_fn, A, B)
     
     try:
         G = pd.read_csv(label_file_name)
@@ -19,22 +48,28 @@ def load_data(left_file_name, right_file_name, label_file_name, blocking_fn, inc
     except:
         G=None
         print(f"[LOAD_DATA] No ground truth file found", flush=True)
-    
-    print(f"[LOAD_DATA] Starting blocking (LxR)...", flush=True)
+    return A, B, G
+
+
+def block_candset(blocking_fn, L, R, cache_dir, name, label, report, matches_df=None):
+    """
+    CandidateSet of blocking_fn(L, R) (cached in cache_dir as `name`),
+    recorded in the BlockingReport as stage "blocking <label>" with pair
+    completeness against matches_df if given. A self-join (L is R) yields
+    every unordered pair once.
+    """
+    print(f"[LOAD_DATA] Starting blocking ({label})...", flush=True)
     sys.stdout.flush()
-    C = blocking_fn(A, B)
-    print(f"[LOAD_DATA] Blocking (LxR) completed: {len(C)} candidate pairs", flush=True)
-    
-    if include_self_join:
-        print(f"[LOAD_DATA] Starting self-join blocking (LxL)...", flush=True)
-        sys.stdout.flush()
-        C_A = blocking_fn(A, A)
-        print(f"[LOAD_DATA] Blocking (LxL) completed: {len(C_A)} candidate pairs", flush=True)
-        
-        print(f"[LOAD_DATA] Starting self-join blocking (RxR)...", flush=True)
-        sys.stdout.flush()
-        C_B = blocking_fn(B, B)
-        print(f"[LOAD_DATA] Blocking (RxR) completed: {len(C_B)} candidate pairs", flush=True)
-        return A, B, G, C, C_A,C_B
-    else:
-        return A, B, G, C
+    cached = cache_dir is not None and exists(feature_store_path(cache_dir, name, "npy"))
+    with report.stage("blocking " + label, cached=cached):
+        #Only the pair positions are kept, not the output attributes the blocker copied per pair
+        C = CandidateSet.from_candset(cached_blocking(blocking_fn, L, R, cache_dir, name), L, R)
+        if L is R:
+            #Self-join: (a, b) and (b, a) are the same pair and (a, a) is no pair at all
+            C = C.unordered()
+    record = report.add_candset(name, C, matches_df)
+    completeness = record["pair_completeness"]
+    print(f"[LOAD_DATA] Blocking ({label}) completed: {len(C)} candidate pairs, reduction ratio "
+          f"{record['reduction_ratio']:.4f}" + ("" if completeness is None else f", pair completeness {completeness:.4f}"),
+          flush=True)
+    return C
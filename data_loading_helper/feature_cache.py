@@ -0,0 +1,130 @@
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+from os.path import dirname, exists, join
+
+from .feature_store import load_features, save_features
+
+#Candset columns kept in the blocking cache; feature extraction only needs the keys
+CANDSET_ID_COLUMNS = ["_id", "ltable_id", "rtable_id"]
+
+#Modules of this package that the cached blocking output goes through (loading, preprocessing, candsets)
+BLOCKING_MODULES = ("candidate_set", "data_loader", "table_loader")
+
+_PACKAGE_DIR = dirname(os.path.abspath(__file__))
+
+
+def _digest(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()[:16]
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Content hash of a file (path independent)."""
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _module_digests(modules):
+    return [file_digest(join(_PACKAGE_DIR, module + ".py")) for module in modules]
+
+
+def blocking_fingerprint(blocking_fn):
+    """
+    Identity of a blocking function: qualified name, source code (so a changed
+    overlap_size literal is a different function), bound functools.partial
+    arguments and closure values, plus the whole file it is defined in (its
+    helpers: OverlapIndex, MinHashIndex, ...) and the BLOCKING_MODULES.
+    """
+    parts = []
+    fn = blocking_fn
+    while isinstance(fn, functools.partial):
+        parts.append(repr(fn.args) + repr(sorted(fn.keywords.items())))
+        fn = fn.func
+    parts.append(getattr(fn, "__module__", "") + "." + getattr(fn, "__qualname__", repr(fn)))
+    try:
+        parts.append(inspect.getsource(fn))
+        parts.append(file_digest(inspect.getsourcefile(fn)))
+    except (OSError, TypeError):
+        pass
+    for cell in getattr(fn, "__closure__", None) or ():
+        parts.append(repr(cell.cell_contents))
+    parts.extend(_module_digests(BLOCKING_MODULES))
+    return _digest(*parts)
+
+
+def feature_table_fingerprint():
+    """Hash of the code that decides which features are generated and how: every module of this package."""
+    modules = sorted(os.path.basename(path)[:-3] for path in glob.glob(join(_PACKAGE_DIR, "*.py")))
+    return _digest(*(modules + _module_digests(modules)))
+
+
+class FeatureCache:
+    """
+    Content-addressed cache directories for one dataset.
+
+    Blocking output lives in <dataset>/cache/blocking_<key>, where the key
+    hashes the table files, metadata.txt, the blocking function and the
+    blocking parameters. Feature matrices live in a features_<key>
+    subdirectory whose key adds the ground-truth file (it sets the gold
+    column) and the feature table definition, so every variant is kept side
+    by side and only stale parts are recomputed.
+    """
+
+    def __init__(self, dataset_path, table_files, blocking_fn, label_files=(), **params):
+        self.dataset_path = dataset_path
+        self.root = join(dataset_path, "cache")
+        inputs = {"files": {os.path.basename(path): file_digest(path) for path in table_files if exists(path)},
+                  "blocking_fn": getattr(blocking_fn, "__name__", repr(blocking_fn)),
+                  "blocking_fingerprint": blocking_fingerprint(blocking_fn),
+                  "params": {name: repr(value) for name, value in sorted(params.items())}}
+        self.blocking_key = _digest(json.dumps(inputs, sort_keys=True))
+        labels = {os.path.basename(path): file_digest(path) for path in label_files if exists(path)}
+        self.feature_key = _digest(self.blocking_key, json.dumps(labels, sort_keys=True), feature_table_fingerprint())
+        self.blocking_dir = join(self.root, "blocking_" + self.blocking_key)
+        self.feature_dir = join(self.blocking_dir, "features_" + self.feature_key)
+        self._inputs = inputs
+
+    def prepare(self):
+        """Create the cache directories and record the inputs the keys were derived from."""
+        os.makedirs(self.feature_dir, exist_ok=True)
+        with open(join(self.blocking_dir, "inputs.json"), "w") as f:
+            json.dump(self._inputs, f, indent=2, sort_keys=True)
+
+    def mark_latest(self):
+        """Point tools that only know the dataset (diagnose_zeroer.py, ...) at these features."""
+        with open(join(self.root, "LATEST"), "w") as f:
+            f.write(os.path.relpath(self.feature_dir, self.dataset_path))
+
+
+def latest_feature_dir(dataset_path):
+    """Feature directory of the last zeroer.py run, or dataset_path for pre-cache layouts."""
+    try:
+        with open(join(dataset_path, "cache", "LATEST")) as f:
+            return join(dataset_path, f.read().strip())
+    except FileNotFoundError:
+        return dataset_path
+
+
+def cached_blocking(blocking_fn, A, B, cache_dir, name):
+    """Run blocking_fn(A, B) unless a candset called `name` is cached in cache_dir."""
+    if cache_dir is not None:
+        try:
+            C = load_features(cache_dir, name, fmt="npy", mmap=False)
+            print(f"[CACHE] Reusing blocking output {name} from {cache_dir}", flush=True)
+            return C
+        except FileNotFoundError:
+            pass
+    C = blocking_fn(A, B)
+    if cache_dir is not None:
+        save_features(C[CANDSET_ID_COLUMNS], cache_dir, name, "npy")
+    return C
@@ -1,20 +1,21 @@
 import pandas as pd
 import numpy as np
 import py_entitymatching as em
+from .blocking_report import is_match
+from .candidate_set import CandidateSet
 from .magellan_modified_feature_generation import get_features
+from .parallel_features import extract_feature_matrix
+from .token_features import extract_set_features, is_set_feature
 
 
 #Given a CANDIDATE SET and the list of ACTUAL duplicates (duplicates_df),
-#this function adds the 1/0 labels (column name = GOLD) to the candset dataframe
+#this function adds the 1/0 labels (column name = GOLD) to the candset dataframe (in place)
 def add_labels_to_candset(duplicates_df, candset_df, ltable_df, rtable_df):
-    #We are overwriting column names - but thats okay as this is not used anywhere else.
-    duplicates_df.columns = ["ltable_id", "rtable_id"]
-
-    #We merged two DF based on the common attributes. The indicator 'gold' takes three values both, left_only, right_only
-    df_with_gold = pd.merge(candset_df, duplicates_df, on=['ltable_id', 'rtable_id'], how='left', indicator='gold')
-
-    #If it is present in both, then it is a duplicate and we set it to 1 and 0 otherwise
-    df_with_gold['gold'] = np.where(df_with_gold.gold == 'both', 1, 0)
+    #(ltable_id, rtable_id) pairs are compared as int64 keys, so no merge of the candset with the duplicates is needed
+    #and a duplicate listed twice does not duplicate its candset row
+    df_with_gold = candset_df
+    df_with_gold['gold'] = is_match(df_with_gold['ltable_id'].values, df_with_gold['rtable_id'].values,
+                                    duplicates_df).astype(np.uint8)
 
     #This is to handle some Magellan issues
     em.set_key(df_with_gold, '_id')
@@ -85,7 +86,8 @@ def get_features_for_type(column_type):
     return features
 
 
-def extract_features(ltable_df, rtable_df, candset_df):
+#Feature table (as in magellan_modified_feature_generation.get_features) used for a pair of tables, and the tokenizers it refers to
+def get_feature_table(ltable_df, rtable_df):
     tokenizers = em.get_tokenizers_for_matching()
     sim_functions = em.get_sim_funs_for_matching()
     left_attr_types = em.get_attr_types(ltable_df)
@@ -115,16 +117,34 @@ def extract_features(ltable_df, rtable_df, candset_df):
             if func in feature:
                 keep_features[i] = False
     feature_records = feature_records.loc[keep_features,:]
+    return feature_records, tokenizers
+
+
+#candset_df holds the ids and gold labels; the pairs are taken from candset (a CandidateSet over ltable_df/rtable_df) if given
+def extract_features(ltable_df, rtable_df, candset_df, candset=None):
+    feature_records, tokenizers = get_feature_table(ltable_df, rtable_df)
 
     print("\n\nExtracting the full set of features:")
-    # Limit parallel jobs to avoid CPU overload
-    # Use n_jobs=4 for large datasets, or adjust based on candidate set size
     import os
-    n_jobs = int(os.environ.get('ZEROER_N_JOBS', '4'))  # Default to 4 cores
-    if len(candset_df) > 100000:
-        n_jobs = min(4, n_jobs)  # Limit to 4 cores for very large datasets
+    n_jobs = int(os.environ.get('ZEROER_N_JOBS', '4'))
     print(f"Using {n_jobs} parallel jobs for feature extraction...")
-    candset_features_df = em.extract_feature_vecs(candset_df,feature_table=feature_records,attrs_after='gold',show_progress=True,n_jobs=n_jobs)
+
+    #Set-based features are computed in bulk from tokens cached per record, the rest by the
+    #feature functions in a process pool that shares the tables instead of copying them per job
+    set_features = feature_records.apply(lambda feature: is_set_feature(feature, tokenizers), axis=1).values
+    other_records = feature_records.loc[~set_features, :]
+    if candset is None:
+        candset = CandidateSet.from_candset(candset_df, ltable_df, rtable_df)
+    l_idx, r_idx = candset.l_idx, candset.r_idx
+    candset_features_df = candset_df[['_id', 'ltable_id', 'rtable_id', 'gold']].copy()
+    other_features = extract_feature_matrix(ltable_df, rtable_df, l_idx, r_idx, other_records, n_jobs)
+    other_features_df = pd.DataFrame(other_features, columns=list(other_records.feature_name), index=candset_features_df.index)
+    set_features_df = extract_set_features(ltable_df, rtable_df, l_idx, r_idx, feature_records.loc[set_features, :], tokenizers)
+    set_features_df.index = candset_features_df.index
+    candset_features_df = pd.concat([candset_features_df, other_features_df, set_features_df], axis=1)
+    feature_names = list(feature_records.feature_name)
+    leading = [col for col in candset_features_df.columns if col not in feature_names and col != 'gold']
+    candset_features_df = candset_features_df[leading + feature_names + ['gold']]
     candset_features_df.fillna(value=0, inplace=True)
 
     return candset_features_df
@@ -144,16 +164,16 @@ def extract_features_auto(ltable_df, rtable_df, candset_df):
 
 
 #High level function which just adds labels and the complete set of features to candset
-def gather_features_and_labels(ltable_df, rtable_df, labels_df, candset_df):
+#(a CandidateSet over ltable_df/rtable_df, or a Magellan candset DataFrame)
+def gather_features_and_labels(ltable_df, rtable_df, labels_df, candset):
+    #The labels keep the dtypes they were read with, is_match normalizes them to the (string) table ids
     labels_df.columns = ["ltable_id", "rtable_id"]
-    labels_df["ltable_id"] = labels_df["ltable_id"].astype(str)
-    labels_df["rtable_id"] = labels_df["rtable_id"].astype(str)
-    candset_df["ltable_id"] = candset_df["ltable_id"].astype(str)
-    candset_df["rtable_id"] = candset_df["rtable_id"].astype(str)
     ltable_df["id"] = ltable_df["id"].astype(str)
     rtable_df["id"] = rtable_df["id"].astype(str)
-    candset_df = add_labels_to_candset(labels_df, candset_df, ltable_df, rtable_df)
-    candset_features_df = extract_features(ltable_df, rtable_df, candset_df)
+    if not isinstance(candset, CandidateSet):
+        candset = CandidateSet.from_candset(candset, ltable_df, rtable_df)
+    candset_df = add_labels_to_candset(labels_df, candset.to_frame(), ltable_df, rtable_df)
+    candset_features_df = extract_features(ltable_df, rtable_df, candset_df, candset)
         
     return candset_features_df
 
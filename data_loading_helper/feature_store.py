@@ -0,0 +1,103 @@
+import json
+from os.path import exists, join
+
+import numpy as np
+import pandas as pd
+
+#Columns of a candset feature table that are not similarity features
+ID_COLUMNS = ["_id", "ltable_id", "rtable_id", "gold"]
+
+#Formats in the order load_features probes them when no format is given
+STORE_FORMATS = ["npy", "feather", "parquet", "csv"]
+
+
+def feature_store_path(dataset_path, name, fmt):
+    """Main file of a stored feature table (for "npy" the float matrix)."""
+    return join(dataset_path, name + "." + fmt)
+
+
+def _ids_path(dataset_path, name):
+    return join(dataset_path, name + "_ids.npz")
+
+
+def _meta_path(dataset_path, name):
+    return join(dataset_path, name + "_meta.json")
+
+
+def _to_storable(values):
+    #np.save cannot memory-map or unpickle object arrays, strings are stored as fixed-width unicode
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = values.astype(str)
+    return values
+
+
+def save_features(candset_features_df, dataset_path, name="candset_features_df", fmt="npy", dtype=np.float32):
+    """
+    Store a candset feature table under dataset_path.
+
+    fmt is one of STORE_FORMATS. "npy" writes the similarity features as a
+    single `dtype` matrix (<name>.npy) with the id/label columns in a
+    <name>_ids.npz sidecar and the column order in <name>_meta.json;
+    "feather"/"parquet" need pyarrow; "csv" is the legacy layout.
+    """
+    if fmt == "csv":
+        candset_features_df.to_csv(feature_store_path(dataset_path, name, fmt))
+        return
+    df = candset_features_df.reset_index(drop=True)
+    if fmt == "feather":
+        df.to_feather(feature_store_path(dataset_path, name, fmt))
+    elif fmt == "parquet":
+        df.to_parquet(feature_store_path(dataset_path, name, fmt))
+    elif fmt == "npy":
+        id_cols = [col for col in df.columns if col in ID_COLUMNS]
+        feature_cols = [col for col in df.columns if col not in ID_COLUMNS]
+        np.save(feature_store_path(dataset_path, name, fmt), df[feature_cols].to_numpy(dtype=dtype))
+        np.savez(_ids_path(dataset_path, name), **{col: _to_storable(df[col].values) for col in id_cols})
+        with open(_meta_path(dataset_path, name), "w") as f:
+            json.dump({"columns": list(df.columns), "feature_columns": feature_cols,
+                       "dtype": np.dtype(dtype).name}, f)
+    else:
+        raise ValueError("Unknown feature store format: " + str(fmt))
+
+
+def _load_npy(dataset_path, name, mmap):
+    with open(_meta_path(dataset_path, name)) as f:
+        meta = json.load(f)
+    matrix = np.load(feature_store_path(dataset_path, name, "npy"), mmap_mode="r" if mmap else None)
+    df = pd.DataFrame(matrix, columns=meta["feature_columns"], copy=False)
+    with np.load(_ids_path(dataset_path, name)) as ids:
+        for col in meta["columns"]:
+            if col in ids.files:
+                values = ids[col]
+                if values.dtype.kind == "U":
+                    values = values.astype(object)
+                df.insert(meta["columns"].index(col), col, values)
+    return df
+
+
+def load_features(dataset_path, name="candset_features_df", fmt=None, mmap=True):
+    """
+    Load a candset feature table stored by save_features.
+
+    If fmt is None the first format found in STORE_FORMATS is used, so older
+    datasets that only have <name>.csv keep working. With mmap the "npy"
+    matrix and "feather" file are memory-mapped instead of read into memory.
+    Raises FileNotFoundError if the table is not stored in any format.
+    """
+    formats = STORE_FORMATS if fmt is None else [fmt]
+    for fmt in formats:
+        path = feature_store_path(dataset_path, name, fmt)
+        if not exists(path):
+            continue
+        if fmt == "npy":
+            return _load_npy(dataset_path, name, mmap)
+        if fmt == "feather":
+            import pyarrow.feather as feather
+            return feather.read_table(path, memory_map=mmap).to_pandas()
+        if fmt == "parquet":
+            return pd.read_parquet(path, memory_map=mmap)
+        df = pd.read_csv(path, index_col=0)
+        df.reset_index(drop=True, inplace=True)
+        return df
+    raise FileNotFoundError("No stored features for " + name + " in " + dataset_path)
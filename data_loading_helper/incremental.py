@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+import py_entitymatching as em
+from os.path import exists, join
+
+from .blocking_report import is_match
+from .candidate_set import CandidateSet, blocks_per_pair
+from .data_loader import load_tables
+from .feature_cache import CANDSET_ID_COLUMNS
+from .feature_extraction import gather_features_and_labels
+from .feature_store import load_features, save_features
+
+
+""" Incremental feature generation: when records are added to (or changed
+in) the tables, only the new/changed records are blocked against the
+tables, features are extracted for the resulting pairs only and merged
+into the feature tables of the previous run. This needs a blocker marked
+with per_pair_blocker: blocking a subset of a table with a blocker that
+picks its settings from the tables it is given (generic_blocking_func, the
+MinHash/LSH blockers) does not yield the pairs of blocking the whole
+tables, so those runs re-block the whole tables instead.
+"""
+
+
+def _table_state_path(feature_dir, side):
+    return join(feature_dir, "table_state_" + side + ".npz")
+
+
+def table_state(table_df):
+    """Ids (as strings) and a content hash of every record."""
+    ids = table_df["id"].astype(str).values
+    hashes = pd.util.hash_pandas_object(table_df.drop(columns=["id"]), index=False).values
+    return ids, hashes
+
+
+def save_table_state(table_df, feature_dir, side):
+    ids, hashes = table_state(table_df)
+    np.savez(_table_state_path(feature_dir, side), ids=ids.astype(str), hashes=hashes)
+
+
+def has_table_state(feature_dir):
+    return all(exists(_table_state_path(feature_dir, side)) for side in ("l", "r"))
+
+
+def diff_table(table_df, feature_dir, side):
+    """Ids of records that are new or changed since the stored state, and ids of removed records."""
+    with np.load(_table_state_path(feature_dir, side)) as state:
+        old_ids, old_hashes = state["ids"].astype(object), state["hashes"]
+    ids, hashes = table_state(table_df)
+    pos = pd.Index(old_ids).get_indexer(ids)
+    fresh = (pos < 0) | (old_hashes[np.maximum(pos, 0)] != hashes)
+    removed = ~np.isin(old_ids, ids)
+    return ids[fresh], old_ids[removed]
+
+
+def block_new_records(blocking_fn, A, B, fresh_l_ids, fresh_r_ids):
+    """
+    Candidate pairs of blocking_fn(A, B) that involve at least one fresh
+    record. A self-join (A is B) yields every unordered pair once. Raises
+    ValueError for a blocking_fn that is not marked with per_pair_blocker.
+    """
+    if not blocks_per_pair(blocking_fn):
+        raise ValueError("The blocking function does not decide per pair, "
+                         "its candidate pairs can only be updated by blocking the whole tables")
+    parts = []
+    if len(fresh_l_ids):
+        A_new = A[A["id"].astype(str).isin(fresh_l_ids)].reset_index(drop=True)
+        em.set_key(A_new, "id")
+        parts.append(blocking_fn(A_new, B)[["ltable_id", "rtable_id"]])
+    if A is B:
+        #The fresh records were blocked against the whole table, which covers both orientations. The
+        #blocker's own self-join path is not taken (A_new is not A), unordered() drops the mirrored pairs
+        #and the self pairs it skips
+        if not parts:
+            return pd.DataFrame(columns=CANDSET_ID_COLUMNS)
+        return CandidateSet.from_candset(parts[0], A, A).unordered().to_frame()
+    if len(fresh_r_ids):
+        B_new = B[B["id"].astype(str).isin(fresh_r_ids)].reset_index(drop=True)
+        em.set_key(B_new, "id")
+        parts.append(blocking_fn(A, B_new)[["ltable_id", "rtable_id"]])
+    if not parts:
+        return pd.DataFrame(columns=CANDSET_ID_COLUMNS)
+    C = pd.concat(parts, ignore_index=True).drop_duplicates()
+    C.reset_index(drop=True, inplace=True)
+    C.insert(0, "_id", np.arange(len(C)))
+    return C
+
+
+def merge_features(old_features_df, new_features_df, stale_l_ids, stale_r_ids, labels_df):
+    """Drop old rows of stale records, append the new rows and recompute _id and gold."""
+    keep = ~(old_features_df["ltable_id"].astype(str).isin(stale_l_ids) |
+             old_features_df["rtable_id"].astype(str).isin(stale_r_ids))
+    columns = list(old_features_df.columns)
+    missing = set(new_features_df.columns) ^ set(columns)
+    if len(new_features_df) and missing:
+        print(f"[INCREMENTAL] Feature columns differ from the previous run, aligning to previous columns: {sorted(missing)}")
+    new_features_df = new_features_df.reindex(columns=columns, fill_value=0)
+    merged = pd.concat([old_features_df[keep], new_features_df], ignore_index=True)
+    merged["_id"] = np.arange(len(merged))
+    merged["gold"] = is_match(merged["ltable_id"].values, merged["rtable_id"].values, labels_df).astype(np.uint8)
+    return merged
+
+
+def _identity_labels(table_df):
+    labels_df = pd.DataFrame()
+    labels_df["l_id"] = table_df["id"]
+    labels_df["r_id"] = table_df["id"]
+    return labels_df
+
+
+def update_features(base_dir, feature_dir, blocking_dir, left_file_name, right_file_name, label_file_name,
+                    blocking_fn, include_self_join=False, LR_identical=False, fmt="npy"):
+    """
+    Bring the feature tables stored in base_dir up to date with the current
+    tables and store them (and the matching candsets) in feature_dir /
+    blocking_dir. Returns {feature table name: DataFrame}.
+    """
+    A, B, G = load_tables(left_file_name, right_file_name, label_file_name, blocking_fn)
+    if G is None:
+        G = pd.DataFrame(columns=["ltable_id", "rtable_id"])
+    fresh_l, removed_l = diff_table(A, base_dir, "l")
+    fresh_r, removed_r = diff_table(B, base_dir, "r")
+    print(f"[INCREMENTAL] Left table: {len(fresh_l)} new/changed, {len(removed_l)} removed records", flush=True)
+    print(f"[INCREMENTAL] Right table: {len(fresh_r)} new/changed, {len(removed_r)} removed records", flush=True)
+    stale_l = np.concatenate((fresh_l, removed_l))
+    stale_r = np.concatenate((fresh_r, removed_r))
+
+    jobs = [("candset_features_df", "candset", A, B, G, fresh_l, fresh_r, stale_l, stale_r)]
+    if include_self_join:
+        jobs.append(("candset_features_df_l", "candset_l", A, A, _identity_labels(A), fresh_l, fresh_l, stale_l, stale_l))
+        jobs.append(("candset_features_df_r", "candset_r", B, B, _identity_labels(B), fresh_r, fresh_r, stale_r, stale_r))
+
+    results = {}
+    for name, candset_name, L, R, labels_df, fresh_lo, fresh_ro, stale_lo, stale_ro in jobs:
+        old_features_df = load_features(base_dir, name, mmap=False)
+        new_candset_df = block_new_records(blocking_fn, L, R, fresh_lo, fresh_ro)
+        if LR_identical:
+            new_candset_df = new_candset_df.loc[new_candset_df.ltable_id.astype(str) != new_candset_df.rtable_id.astype(str), :]
+            new_candset_df.reset_index(inplace=True, drop=True)
+            new_candset_df['_id'] = new_candset_df.index
+        print(f"[INCREMENTAL] {name}: {len(new_candset_df):,} new candidate pairs", flush=True)
+        if len(new_candset_df):
+            new_features_df = gather_features_and_labels(L, R, labels_df.copy(), new_candset_df)
+        else:
+            new_features_df = old_features_df.iloc[:0]
+        merged = merge_features(old_features_df, new_features_df, stale_lo, stale_ro, labels_df)
+        save_features(merged, feature_dir, name, fmt)
+        save_features(merged[CANDSET_ID_COLUMNS], blocking_dir, candset_name, "npy")
+        results[name] = merged
+
+    save_table_state(A, feature_dir, "l")
+    save_table_state(B, feature_dir, "r")
+    return results
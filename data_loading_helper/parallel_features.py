@@ -0,0 +1,219 @@
+import os
+import shutil
+import tempfile
+from multiprocessing import get_context
+from os.path import join
+
+import numpy as np
+import pandas as pd
+import py_entitymatching as em
+from tqdm import tqdm
+
+
+""" Process-pool extraction of Magellan feature functions. The table
+columns the features read are written once as memory-mapped arrays
+(strings in an Arrow-like layout: utf-8 bytes + offsets + null mask) in a
+RAM-backed directory, so workers share them instead of receiving pickled
+copies of the tables and the candset. Workers get (start, stop) ranges of
+the candidate pair index arrays of a batch and write their feature rows
+straight into a preallocated memory-mapped output matrix.
+"""
+
+#State of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _shared_dir():
+    #/dev/shm is RAM backed, files mapped from it are shared memory
+    return tempfile.mkdtemp(prefix="zeroer_features_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+
+def _save_array(directory, name, values):
+    path = join(directory, name + ".npy")
+    np.save(path, values)
+    return path
+
+
+def _load_array(path):
+    return np.load(path, mmap_mode="r")
+
+
+def share_table(table_df, attrs, directory, side):
+    """Store the columns attrs of a table under directory; returns a picklable {attr: column spec}."""
+    spec = {}
+    for i, attr in enumerate(attrs):
+        prefix = side + "_" + str(i)
+        values = table_df[attr].values
+        if values.dtype != object:
+            spec[attr] = ("values", _save_array(directory, prefix, values))
+            continue
+        null = pd.isnull(values)
+        encoded = [b"" if is_null else str(value).encode("utf-8") for value, is_null in zip(values, null)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        #One padding byte, a memory map cannot be empty
+        data = np.frombuffer(b"".join(encoded) + b"\0", dtype=np.uint8)
+        spec[attr] = ("str", _save_array(directory, prefix + "_data", data),
+                      _save_array(directory, prefix + "_offsets", offsets), _save_array(directory, prefix + "_null", null))
+    return spec
+
+
+class _StringColumn:
+    def __init__(self, data_path, offsets_path, null_path):
+        self.data = _load_array(data_path)
+        self.offsets = _load_array(offsets_path)
+        self.null = _load_array(null_path)
+
+    def __getitem__(self, i):
+        if self.null[i]:
+            return np.nan
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+
+def _attach_table(spec):
+    columns = {}
+    for attr, column in spec.items():
+        if column[0] == "str":
+            columns[attr] = _StringColumn(*column[1:])
+        else:
+            columns[attr] = _load_array(column[1])
+    return columns
+
+
+def _compile_features(feature_sources):
+    #Same namespace magellan_modified_feature_generation.conv_fn_str_to_obj executes the sources in
+    namespace = {}
+    namespace.update(em.get_tokenizers_for_matching())
+    namespace.update(em.get_sim_funs_for_matching())
+    functions = []
+    for name, source in feature_sources:
+        exec(source, namespace)
+        functions.append(namespace[name])
+    return functions
+
+
+def _init_worker(table_specs, feature_sources):
+    _worker["tables"] = [_attach_table(spec) for spec in table_specs]
+    _worker["functions"] = _compile_features(feature_sources)
+    _worker["batch"] = None
+
+
+def _attach_batch(pair_paths, out_path):
+    #A worker maps the pair index arrays and output matrix of a batch once, on its first chunk of that batch
+    if _worker["batch"] != out_path:
+        _worker["pairs"] = [_load_array(path) for path in pair_paths]
+        _worker["out"] = np.load(out_path, mmap_mode="r+")
+        _worker["batch"] = out_path
+
+
+def _extract_chunk(task):
+    pair_paths, out_path, start, stop = task
+    _attach_batch(pair_paths, out_path)
+    ltable, rtable = _worker["tables"]
+    l_idx, r_idx = _worker["pairs"]
+    functions = _worker["functions"]
+    out = _worker["out"]
+    #Records are rebuilt once per chunk, like the per-split tuple dicts of em.extract_feature_vecs
+    l_records, r_records = {}, {}
+    for k in range(start, stop):
+        l, r = l_idx[k], r_idx[k]
+        if l not in l_records:
+            l_records[l] = {attr: column[l] for attr, column in ltable.items()}
+        if r not in r_records:
+            r_records[r] = {attr: column[r] for attr, column in rtable.items()}
+        ltuple, rtuple = l_records[l], r_records[r]
+        out[k] = [function(ltuple, rtuple) for function in functions]
+    out.flush()
+    return stop - start
+
+
+class FeatureExtractor:
+    """
+    Evaluates the feature functions of feature_records (rows of a Magellan
+    feature table with function_source) on batches of pairs of ltable_df
+    and rtable_df with n_jobs processes (-1 for all cores). The tables are
+    shared and the workers started once, when the extractor is entered, so
+    a batch only ships its pair index arrays and output matrix.
+    """
+
+    def __init__(self, ltable_df, rtable_df, feature_records, n_jobs=1, chunk_size=10000):
+        self.ltable_df = ltable_df
+        self.rtable_df = rtable_df
+        self.feature_records = feature_records
+        self.n_jobs = os.cpu_count() if n_jobs < 0 else max(1, n_jobs)
+        self.chunk_size = chunk_size
+        self.directory = None
+        self.pool = None
+        self.n_batches = 0
+
+    def __enter__(self):
+        if self.feature_records.shape[0] == 0:
+            return self
+        self.directory = _shared_dir()
+        try:
+            table_specs = (share_table(self.ltable_df, sorted(set(self.feature_records.left_attribute)), self.directory, "l"),
+                           share_table(self.rtable_df, sorted(set(self.feature_records.right_attribute)), self.directory, "r"))
+            feature_sources = list(zip(self.feature_records.feature_name, self.feature_records.function_source))
+            if self.n_jobs == 1:
+                _init_worker(table_specs, feature_sources)
+            else:
+                self.pool = get_context().Pool(self.n_jobs, _init_worker, (table_specs, feature_sources))
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        _worker.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def extract(self, l_idx, r_idx, show_progress=True):
+        """Float64 (#pairs x #features) matrix of the pairs (ltable_df.iloc[l_idx], rtable_df.iloc[r_idx])."""
+        n_pairs = len(l_idx)
+        if n_pairs == 0 or self.feature_records.shape[0] == 0:
+            return np.zeros((n_pairs, self.feature_records.shape[0]))
+        prefix = "batch_" + str(self.n_batches)
+        self.n_batches += 1
+        pair_paths = (_save_array(self.directory, prefix + "_l_idx", np.asarray(l_idx, dtype=np.int64)),
+                      _save_array(self.directory, prefix + "_r_idx", np.asarray(r_idx, dtype=np.int64)))
+        out_path = join(self.directory, prefix + "_features.npy")
+        out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float64,
+                                        shape=(n_pairs, self.feature_records.shape[0]))
+        del out
+        try:
+            tasks = [(pair_paths, out_path, start, min(start + self.chunk_size, n_pairs))
+                     for start in range(0, n_pairs, self.chunk_size)]
+            with tqdm(total=n_pairs, disable=not show_progress) as pbar:
+                if self.pool is None:
+                    for task in tasks:
+                        pbar.update(_extract_chunk(task))
+                else:
+                    for done in self.pool.imap_unordered(_extract_chunk, tasks):
+                        pbar.update(done)
+            #The mapping stays valid after the files are removed, so the result is not copied
+            return np.load(out_path, mmap_mode="r+")
+        finally:
+            for path in pair_paths + (out_path,):
+                os.remove(path)
+
+
+def extract_feature_matrix(ltable_df, rtable_df, l_idx, r_idx, feature_records, n_jobs=1, chunk_size=10000, show_progress=True):
+    """
+    Evaluate the feature functions of feature_records (rows of a Magellan
+    feature table with function_source) on the pairs
+    (ltable_df.iloc[l_idx], rtable_df.iloc[r_idx]) with n_jobs processes
+    (-1 for all cores). Returns a float64 (#pairs x #features) matrix.
+    """
+    if len(l_idx) == 0 or feature_records.shape[0] == 0:
+        return np.zeros((len(l_idx), feature_records.shape[0]))
+    with FeatureExtractor(ltable_df, rtable_df, feature_records, n_jobs, chunk_size) as extractor:
+        return extractor.extract(l_idx, r_idx, show_progress)
@@ -0,0 +1,95 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import py_entitymatching as em
+
+from .blocking_report import BlockingReport
+from .data_loader import block_candset, load_tables
+from .feature_extraction import gather_features_and_labels
+from .feature_store import load_features, save_features
+from .incremental import _identity_labels, save_table_state
+
+
+""" Feature generation for the candsets of a run as independent pipelines:
+LxR, plus LxL and RxR when transitivity is enforced. Each pipeline blocks
+its pair of tables, extracts the features of its candset and stores them.
+With n_jobs > 1 the pipelines run concurrently in a process pool and share
+n_jobs between them for feature extraction, so a transitivity run takes
+about as long as its slowest pipeline instead of the sum of the three.
+"""
+
+
+def _run_pipeline(label, name, candset_name, L, R, labels_df, matches_df, drop_self_matches, blocking_fn,
+                  blocking_dir, feature_dir, fmt, n_jobs):
+    #extract_features reads its number of processes from the environment
+    os.environ["ZEROER_N_JOBS"] = str(n_jobs)
+    #In a worker process the tables are unpickled copies, unknown to its Magellan catalog
+    em.set_key(L, "id")
+    if R is not L:
+        em.set_key(R, "id")
+    start = time.time()
+    report = BlockingReport(blocking_fn)
+    C = block_candset(blocking_fn, L, R, blocking_dir, candset_name, label, report, matches_df)
+    if drop_self_matches:
+        C = C.drop_self_matches()
+    print(f"[PIPELINE {label}] Extracting features of {len(C):,} candidate pairs with {n_jobs} jobs", flush=True)
+    with report.stage("features " + label):
+        candset_features_df = gather_features_and_labels(L, R, labels_df, C)
+    save_features(candset_features_df, feature_dir, name, fmt)
+    print(f"[PIPELINE {label}] Done in {time.time() - start:.1f}s", flush=True)
+    return report
+
+
+def generate_feature_tables(feature_dir, blocking_dir, left_file_name, right_file_name, label_file_name, blocking_fn,
+                            include_self_join=False, LR_identical=False, fmt="npy", n_jobs=1, report_path=None):
+    """
+    Block the tables, extract features and store the feature tables (and
+    the matching candsets) in feature_dir / blocking_dir, running the LxR,
+    LxL and RxR pipelines on up to n_jobs processes (-1 for all cores).
+    With report_path a BlockingReport of the run is written there.
+    Returns {feature table name: DataFrame}.
+    """
+    report = BlockingReport(blocking_fn)
+    with report.stage("load_tables"):
+        A, B, G = load_tables(left_file_name, right_file_name, label_file_name, blocking_fn)
+    report.add_table("left", left_file_name, A)
+    report.add_table("right", right_file_name, B)
+    report.add_matches(G)
+    labels_df = G if G is not None else pd.DataFrame(columns=["ltable_id", "rtable_id"])
+
+    pipelines = [dict(label="LxR", name="candset_features_df", candset_name="candset", L=A, R=B,
+                      labels_df=labels_df.copy(), matches_df=G, drop_self_matches=LR_identical)]
+    if include_self_join:
+        #Self-join candsets have no ground truth to measure recall against
+        pipelines.append(dict(label="LxL", name="candset_features_df_l", candset_name="candset_l", L=A, R=A,
+                              labels_df=_identity_labels(A), matches_df=None, drop_self_matches=False))
+        pipelines.append(dict(label="RxR", name="candset_features_df_r", candset_name="candset_r", L=B, R=B,
+                              labels_df=_identity_labels(B), matches_df=None, drop_self_matches=False))
+    n_jobs = os.cpu_count() if n_jobs < 0 else max(1, n_jobs)
+    n_workers = min(n_jobs, len(pipelines))
+    for i, pipeline in enumerate(pipelines):
+        #Jobs left over after the even split go to the first (LxR, usually largest) pipelines
+        pipeline.update(blocking_fn=blocking_fn, blocking_dir=blocking_dir, feature_dir=feature_dir, fmt=fmt,
+                        n_jobs=n_jobs // n_workers + (i < n_jobs % n_workers))
+
+    if n_workers == 1:
+        reports = {pipeline["label"]: _run_pipeline(**pipeline) for pipeline in pipelines}
+    else:
+        print(f"[PIPELINE] Running {', '.join(pipeline['label'] for pipeline in pipelines)} on {n_workers} processes",
+              flush=True)
+        reports = {}
+        with ProcessPoolExecutor(n_workers) as pool:
+            futures = {pool.submit(_run_pipeline, **pipeline): pipeline["label"] for pipeline in pipelines}
+            for future in as_completed(futures):
+                reports[futures[future]] = future.result()
+                print(f"[PIPELINE] {futures[future]} finished ({len(reports)}/{len(pipelines)})", flush=True)
+    for pipeline in pipelines:
+        report.extend(reports[pipeline["label"]])
+    if report_path is not None:
+        report.save(report_path)
+
+    save_table_state(A, feature_dir, "l")
+    save_table_state(B, feature_dir, "r")
+    return {pipeline["name"]: load_features(feature_dir, pipeline["name"]) for pipeline in pipelines}
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import py_entitymatching as em
+
+from .blocking_report import is_match
+from .candidate_set import CandidateSet, blocks_per_pair
+from .data_loader import load_tables
+from .feature_cache import CANDSET_ID_COLUMNS
+from .feature_extraction import get_feature_table
+from .feature_store import save_features
+from .incremental import _identity_labels, save_table_state
+from .parallel_features import FeatureExtractor
+from .token_features import TokenCache, extract_set_features, is_set_feature
+
+
+""" Streaming feature generation: the left table is blocked against the
+right table a slice of records at a time, so blocking yields chunks of
+candidate id pairs instead of one candset carrying the output attributes
+of every pair. Features of each chunk are computed against the (id indexed)
+tables and only a float32 feature matrix with the id/label columns is kept.
+Only blockers marked with per_pair_blocker can be streamed: they decide
+every pair from its two records, so the chunks hold exactly the pairs of
+blocking the whole tables. Blockers that pick their settings from the
+tables they are given (generic_blocking_func and its candidate budget, the
+MinHash/LSH blockers) would block every slice differently.
+"""
+
+
+def iter_candidate_chunks(blocking_fn, A, B, block_size=5000):
+    """
+    Yield the pairs of blocking_fn(A, B) as CandidateSets over A and B,
+    block_size left records at a time. For a self-join (A is B) a slice is
+    only blocked against itself and the records after it, and every
+    unordered pair is yielded once. Raises ValueError for a blocking_fn that
+    is not marked with per_pair_blocker.
+    """
+    if not blocks_per_pair(blocking_fn):
+        raise ValueError("The blocking function does not decide per pair and cannot be streamed, "
+                         "block the whole tables instead")
+    for start in range(0, len(A), block_size):
+        A_block = A.iloc[start:start + block_size].reset_index(drop=True)
+        em.set_key(A_block, "id")
+        if A is not B:
+            yield CandidateSet.from_candset(blocking_fn(A_block, B), A, B)
+            continue
+        A_rest = A.iloc[start:].reset_index(drop=True)
+        em.set_key(A_rest, "id")
+        yield CandidateSet.from_candset(blocking_fn(A_block, A_rest), A, A).unordered()
+
+
+def stream_features(ltable_df, rtable_df, labels_df, blocking_fn, block_size=5000, n_jobs=1, drop_self_matches=False):
+    """
+    Candset feature table (_id, ltable_id, rtable_id, features..., gold) of
+    blocking_fn(ltable_df, rtable_df), built chunk by chunk. The features
+    are one float32 block with missing values set to 0.
+    """
+    ltable_df["id"] = ltable_df["id"].astype(str)
+    rtable_df["id"] = rtable_df["id"].astype(str)
+    feature_records, tokenizers = get_feature_table(ltable_df, rtable_df)
+    feature_names = list(feature_records.feature_name)
+    set_features = feature_records.apply(lambda feature: is_set_feature(feature, tokenizers), axis=1).values
+    set_pos, other_pos = np.flatnonzero(set_features), np.flatnonzero(~set_features)
+    cache = TokenCache(tokenizers)
+
+    blocks, l_ids, r_ids = [], [], []
+    #The tables are shared with the feature workers once, each chunk only ships its pair indices
+    with FeatureExtractor(ltable_df, rtable_df, feature_records.iloc[other_pos], n_jobs) as extractor:
+        for C in iter_candidate_chunks(blocking_fn, ltable_df, rtable_df, block_size):
+            if drop_self_matches:
+                C = C.drop_self_matches()
+            l_idx, r_idx = C.l_idx, C.r_idx
+            block = np.empty((len(C), len(feature_names)), dtype=np.float32)
+            block[:, other_pos] = extractor.extract(l_idx, r_idx, show_progress=False)
+            if len(set_pos):
+                block[:, set_pos] = extract_set_features(ltable_df, rtable_df, l_idx, r_idx, feature_records.iloc[set_pos],
+                                                         tokenizers, cache).values
+            block[np.isnan(block)] = 0
+            blocks.append(block)
+            l_ids.append(C.ltable_ids)
+            r_ids.append(C.rtable_ids)
+            print(f"[STREAMING] {sum(len(ids) for ids in l_ids):,} candidate pairs", flush=True)
+
+    features = np.concatenate(blocks) if blocks else np.zeros((0, len(feature_names)), dtype=np.float32)
+    del blocks
+    candset_features_df = pd.DataFrame(features, columns=feature_names, copy=False)
+    ltable_ids = np.concatenate(l_ids) if l_ids else np.array([], dtype=object)
+    rtable_ids = np.concatenate(r_ids) if r_ids else np.array([], dtype=object)
+    candset_features_df.insert(0, "_id", np.arange(len(ltable_ids)))
+    candset_features_df.insert(1, "ltable_id", ltable_ids)
+    candset_features_df.insert(2, "rtable_id", rtable_ids)
+    candset_features_df["gold"] = is_match(ltable_ids, rtable_ids, labels_df).astype(np.uint8)
+    return candset_features_df
+
+
+def stream_feature_tables(feature_dir, blocking_dir, left_file_name, right_file_name, label_file_name, blocking_fn,
+                          include_self_join=False, LR_identical=False, fmt="npy", block_size=5000, n_jobs=1):
+    """
+    Generate the feature tables with stream_features and store them (and
+    the matching candsets) in feature_dir / blocking_dir. Returns
+    {feature table name: DataFrame}.
+    """
+    A, B, G = load_tables(left_file_name, right_file_name, label_file_name, blocking_fn)
+    if G is None:
+        G = pd.DataFrame(columns=["ltable_id", "rtable_id"])
+    jobs = [("candset_features_df", "candset", A, B, G, LR_identical)]
+    if include_self_join:
+        jobs.append(("candset_features_df_l", "candset_l", A, A, _identity_labels(A), False))
+        jobs.append(("candset_features_df_r", "candset_r", B, B, _identity_labels(B), False))
+
+    results = {}
+    for name, candset_name, L, R, labels_df, drop_self_matches in jobs:
+        print(f"[STREAMING] {name}: blocking and extracting features {block_size} records at a time", flush=True)
+        candset_features_df = stream_features(L, R, labels_df, blocking_fn, block_size, n_jobs, drop_self_matches)
+        save_features(candset_features_df, feature_dir, name, fmt)
+        save_features(candset_features_df[CANDSET_ID_COLUMNS], blocking_dir, candset_name, "npy")
+        results[name] = candset_features_df
+
+    save_table_state(A, feature_dir, "l")
+    save_table_state(B, feature_dir, "r")
+    return results
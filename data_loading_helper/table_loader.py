@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import py_entitymatching as em
+from pandas._libs.parsers import STR_NA_VALUES
+
+
+""" CSV ingestion of the entity tables. With pyarrow, every column is read
+with an explicit string schema by Arrow's CSV reader and typed in Arrow the
+way pandas' C parser would infer it: int64/float64 if every value casts to
+a number, bool for True/False columns and text otherwise. Without pyarrow
+the table is read with the C engine. The key column is read as strings, so
+the id dictionary is built once here instead of by astype(str) further
+down; the row position of a record serves as its integer code. Text values
+are interned (one Python string per distinct value, from the dictionary
+encoding of the column), which saves memory on the repetitive attributes
+(brand, category, city, ...) of large tables.
+"""
+
+_BOOLEAN_VALUES = {"True": True, "TRUE": True, "true": True, "False": False, "FALSE": False, "false": False}
+
+
+def _take_strings(uniques, codes):
+    """Values of a dictionary-encoded text column; all True/False strings (no missing) become a bool column."""
+    if len(uniques) and set(uniques) <= _BOOLEAN_VALUES.keys() and (codes >= 0).all():
+        return np.array([_BOOLEAN_VALUES[value] for value in uniques])[codes]
+    #Code -1 (missing) picks the NaN appended last
+    return np.append(uniques, np.nan)[codes]
+
+
+def intern_strings(values):
+    """Object array of values in which equal strings are a single object; missing values become NaN."""
+    codes, uniques = pd.factorize(values)
+    return _take_strings(np.asarray(uniques, dtype=object), codes)
+
+
+def _arrow_column(column, sample_size=10000):
+    """Values of an Arrow string column with the dtype pandas' C parser would infer."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    for arrow_type in (pa.int64(), pa.float64()):
+        try:
+            #Integer columns with missing values come out as float64, as in pandas
+            return pc.cast(column, arrow_type).to_pandas().values
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            pass
+    #Interning needs a dictionary encoding, which only pays off on repetitive columns
+    sample = column.slice(0, sample_size)
+    if pc.count_distinct(sample).as_py() > len(sample) // 2:
+        return column.to_pandas().values
+    categorical = pc.dictionary_encode(column).to_pandas().values
+    return _take_strings(np.asarray(categorical.categories, dtype=object), categorical.codes)
+
+
+def _read_arrow(file_name, key, encoding):
+    import pyarrow as pa
+    from pyarrow import csv
+
+    names = list(pd.read_csv(file_name, nrows=0, encoding=encoding).columns)
+    table = csv.read_csv(file_name,
+                         read_options=csv.ReadOptions(encoding=encoding, column_names=names, skip_rows=1),
+                         parse_options=csv.ParseOptions(newlines_in_values=True),
+                         convert_options=csv.ConvertOptions(column_types={name: pa.string() for name in names},
+                                                            null_values=sorted(STR_NA_VALUES),
+                                                            strings_can_be_null=True))
+    columns = {}
+    for name in names:
+        #Columns are dropped from the Arrow table as they are converted, so its buffers are released early
+        column, table = table.column(0), table.remove_column(0)
+        columns[name] = column.to_pandas().values if name == key else _arrow_column(column)
+        del column
+    return pd.DataFrame(columns, columns=names)
+
+
+def _read_pandas(file_name, key, encoding):
+    table_df = pd.read_csv(file_name, encoding=encoding, dtype={key: str})
+    for name in table_df.columns:
+        if name != key and table_df[name].dtype == object:
+            table_df[name] = intern_strings(table_df[name].values)
+    return table_df
+
+
+def read_table(file_name, key="id", encoding="iso-8859-1"):
+    """
+    Read a table CSV with typed columns and the key column as strings, and
+    register the key in Magellan's catalog (as em.read_csv_metadata does).
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        table_df = _read_pandas(file_name, key, encoding)
+    else:
+        table_df = _read_arrow(file_name, key, encoding)
+    em.set_key(table_df, key)
+    return table_df
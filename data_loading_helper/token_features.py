@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+""" Set-based similarity features (jaccard, cosine, dice, overlap_coeff)
+computed in bulk. Every record is tokenized once per (attribute,
+tokenizer) with the same tokenizer functions Magellan's feature functions
+call and stored as a row of a sparse token-incidence matrix. Intersection
+sizes for all candidate pairs are row-wise dot products of those matrices,
+and the scores follow from them and the set sizes, with the same edge
+cases as py_stringmatching (identical token lists score 1.0, an empty
+token list scores 0 and a missing value gives NaN).
+"""
+
+SET_SIM_FUNCTIONS = ("jaccard", "cosine", "dice", "overlap_coeff")
+
+
+def is_set_feature(feature, tok_funcs):
+    """Whether a row of a feature table can be computed by this module."""
+    return (feature["simfunction"] in SET_SIM_FUNCTIONS
+            and feature["left_attr_tokenizer"] in tok_funcs
+            and feature["left_attr_tokenizer"] == feature["right_attr_tokenizer"])
+
+
+class TokenizedColumn:
+    """Token sets of one attribute of one table under one tokenizer, as CSR rows of token ids."""
+
+    def __init__(self, values, tokenizer, vocabulary):
+        n = len(values)
+        self.sizes = np.full(n, np.nan)
+        #Hash of the token list: Magellan scores identical token lists 1.0 before looking at the sets
+        self.list_hashes = np.zeros(n, dtype=np.int64)
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        indices = []
+        for i, value in enumerate(values):
+            tokens = tokenizer(value) if not pd.isnull(value) else None
+            if isinstance(tokens, list):
+                token_ids = sorted({vocabulary.setdefault(token, len(vocabulary)) for token in tokens})
+                indices.extend(token_ids)
+                self.sizes[i] = len(token_ids)
+                self.list_hashes[i] = hash(tuple(tokens))
+            self.indptr[i + 1] = len(indices)
+        self.indices = np.array(indices, dtype=np.int32)
+        self.vocabulary = vocabulary
+        self.null = np.isnan(self.sizes)
+
+    def matrix(self):
+        """Binary record x token incidence matrix over the tokenizer's current vocabulary."""
+        data = np.ones(self.indices.shape[0], dtype=np.float32)
+        return csr_matrix((data, self.indices, self.indptr), shape=(self.indptr.shape[0] - 1, len(self.vocabulary)))
+
+
+class TokenCache:
+    """
+    Tokenized columns keyed on (table, attribute, tokenizer), so self-joins
+    and features sharing a tokenizer reuse them. Columns tokenized with the
+    same tokenizer share one vocabulary, so their matrices are comparable.
+    """
+
+    def __init__(self, tok_funcs):
+        self.tok_funcs = tok_funcs
+        self._columns = {}
+        self._vocabularies = {}
+
+    def get(self, table_df, attr, tokenizer):
+        key = (id(table_df), attr, tokenizer)
+        if key not in self._columns:
+            vocabulary = self._vocabularies.setdefault(tokenizer, {})
+            self._columns[key] = TokenizedColumn(table_df[attr].values, self.tok_funcs[tokenizer], vocabulary)
+        return self._columns[key]
+
+
+def intersection_sizes(l_col, r_col, l_idx, r_idx, chunk_size=200000):
+    """|tokens(l) & tokens(r)| for every pair, as row-wise dot products of the incidence matrices."""
+    l_matrix, r_matrix = l_col.matrix(), r_col.matrix()
+    sizes = np.zeros(len(l_idx), dtype=np.float64)
+    for start in range(0, len(l_idx), chunk_size):
+        stop = start + chunk_size
+        products = l_matrix[l_idx[start:stop]].multiply(r_matrix[r_idx[start:stop]])
+        sizes[start:stop] = np.asarray(products.sum(axis=1)).ravel()
+    return sizes
+
+
+def set_similarity(simfunction, inter, size_l, size_r, exact):
+    """Vectorized py_stringmatching raw scores from intersection and set sizes."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if simfunction == "jaccard":
+            scores = inter / (size_l + size_r - inter)
+        elif simfunction == "cosine":
+            scores = inter / (np.sqrt(size_l) * np.sqrt(size_r))
+        elif simfunction == "dice":
+            scores = 2.0 * inter / (size_l + size_r)
+        elif simfunction == "overlap_coeff":
+            scores = inter / np.minimum(size_l, size_r)
+        else:
+            raise ValueError("Not a set-based similarity function: " + simfunction)
+    scores[(size_l == 0) | (size_r == 0)] = 0
+    scores[exact] = 1.0
+    scores[np.isnan(size_l) | np.isnan(size_r)] = np.nan
+    return scores
+
+
+def extract_set_features(ltable_df, rtable_df, l_idx, r_idx, feature_records, tok_funcs, cache=None, chunk_size=200000):
+    """
+    Compute the set-based rows of feature_records for the candidate pairs
+    (ltable_df.iloc[l_idx], rtable_df.iloc[r_idx]), chunk_size pairs at a
+    time. Returns a DataFrame with one column per feature, named like the
+    Magellan feature functions.
+    """
+    if cache is None:
+        cache = TokenCache(tok_funcs)
+    features = {}
+    intersections = {}
+    for _, feature in feature_records.iterrows():
+        tokenizer = feature["left_attr_tokenizer"]
+        l_col = cache.get(ltable_df, feature["left_attribute"], tokenizer)
+        r_col = cache.get(rtable_df, feature["right_attribute"], tokenizer)
+        key = (feature["left_attribute"], feature["right_attribute"], tokenizer)
+        if key not in intersections:
+            #All similarity functions over the same token sets share one intersection pass
+            intersections[key] = intersection_sizes(l_col, r_col, l_idx, r_idx, chunk_size)
+        size_l, size_r = l_col.sizes[l_idx], r_col.sizes[r_idx]
+        exact = ~np.isnan(size_l) & ~np.isnan(size_r) & (l_col.list_hashes[l_idx] == r_col.list_hashes[r_idx])
+        features[feature["feature_name"]] = set_similarity(feature["simfunction"], intersections[key], size_l, size_r, exact)
+    return pd.DataFrame(features, columns=list(feature_records["feature_name"]))
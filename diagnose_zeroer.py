@@ -18,20 +18,17 @@ def diagnose_dataset(dataset_name, data_path="datasets"):
     
     dataset_path = join(data_path, dataset_name)
     
-    # Check if feature file exists
-    feature_file = join(dataset_path, "candset_features_df.csv")
-    if not os.path.exists(feature_file):
-        print(f"❌ Feature file not found: {feature_file}")
+    # Load features from whichever format zeroer.py stored them in
+    from data_loading_helper.feature_cache import latest_feature_dir
+    from data_loading_helper.feature_store import load_features
+    try:
+        feature_dir = latest_feature_dir(dataset_path)
+        candset_features_df = load_features(feature_dir, "candset_features_df")
+        print(f"✓ Successfully loaded features from: {feature_dir}")
+    except FileNotFoundError:
+        print(f"❌ No stored features found in: {dataset_path}")
         print("   You need to run zeroer.py first to generate features.")
         return
-    
-    print(f"✓ Feature file found: {feature_file}")
-    
-    # Load features
-    try:
-        candset_features_df = pd.read_csv(feature_file, index_col=0)
-        candset_features_df.reset_index(drop=True, inplace=True)
-        print(f"✓ Successfully loaded features")
     except Exception as e:
         print(f"❌ Error loading features: {e}")
         return
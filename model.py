@@ -1,11 +1,10 @@
 import pickle
 import pandas as pd
-from collections import Counter
 from scipy.optimize import newton
 import numpy as np
-from scipy.stats import norm, multivariate_normal
+from scipy.linalg import solve_triangular
+from scipy.stats import norm
 from sklearn.metrics import precision_score, recall_score, f1_score
-from sklearn.mixture import GaussianMixture
 from tqdm import tqdm
 from collections import defaultdict
 from sklearn.preprocessing import MinMaxScaler
@@ -23,11 +22,15 @@ def get_y_init_given_threshold(similarity_features_df, threshold=0.8):
     x_scaled = min_max_scaler.fit_transform(x)
     scaled_sum = getScaledSum(x_scaled)
     training_labels_ = scaled_sum > threshold
-    y_init = [int(val) for val in training_labels_]
+    y_init = training_labels_.ravel().astype(int).tolist()
     return y_init
 
 
 DEL = 1e-300
+#Rows of X processed at a time by the E-step/M-step kernels, bounding their temporaries
+CHUNK_ROWS = 65536
+#Smaller for the M-step, so a chunk stays in cache between its passes
+MOMENT_CHUNK_ROWS = 4096
 
 def _get_results(true_labels, predicted_labels):
     p = precision_score(true_labels, predicted_labels)
@@ -39,6 +42,187 @@ def bay_coeff(a,b,u):
     return np.exp(-(np.log(a/(b+DEL)+b/(a+DEL)+2)+u/(a+b+DEL)))
 
 
+def _cholesky(cov, max_tries=20):
+    """
+    Lower Cholesky factor of cov. If cov is not positive definite, a jitter
+    is added to its diagonal (in place) until it is: first 10 times the
+    magnitude of its smallest eigenvalue, then ten times more on every
+    failure.
+    """
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        pass
+    min_eig = np.min(np.linalg.eigvalsh(cov))
+    jitter = -10 * min_eig if min_eig < 0 else 1e-8 * max(np.mean(np.diag(cov)), 1.)
+    for _ in range(max_tries):
+        cov[np.diag_indices_from(cov)] += jitter
+        try:
+            return np.linalg.cholesky(cov)
+        except np.linalg.LinAlgError:
+            jitter *= 10
+    raise np.linalg.LinAlgError("Covariance matrix could not be made positive definite")
+
+
+def _gaussian_logpdf(X, mu, chol, chunk_size=CHUNK_ROWS):
+    """
+    Log-density of the rows of X under N(mu, chol chol^T): Mahalanobis terms
+    by one triangular solve per chunk of rows, in the dtype of X, summed in
+    float64.
+    """
+    M = X.shape[1]
+    log_det = 2 * np.sum(np.log(np.diag(chol)))
+    chol = chol.astype(X.dtype, copy=False)
+    mu = np.asarray(mu, dtype=X.dtype)
+    maha = np.empty(X.shape[0])
+    for start in range(0, X.shape[0], chunk_size):
+        centered = X[start:start + chunk_size] - mu
+        z = solve_triangular(chol, centered.T, lower=True, check_finite=False)
+        maha[start:start + chunk_size] = np.einsum('ij,ij->j', z, z, dtype=np.float64)
+    return -0.5 * (M * np.log(2 * np.pi) + log_det + maha)
+
+
+def _centered_cov(S1, S2, n_w, mu):
+    """sum_i w_i (x_i - mu)(x_i - mu)^T / (n_w + DEL) from S1 = w @ X, S2 = X^T diag(w) X and n_w = sum(w)."""
+    cross = np.outer(mu, S1)
+    cov = (S2 - cross - cross.T + n_w * np.outer(mu, mu)) / (n_w + DEL)
+    #A variance that is zero up to rounding must not come out negative
+    diag = np.diag_indices_from(cov)
+    cov[diag] = np.clip(cov[diag], 0, None)
+    return cov
+
+
+def encode_id_pairs(id_dfs):
+    """
+    (n, 2) int32 code arrays of the (ltable_id, rtable_id) frames in id_dfs
+    (None stays None), encoded with one dictionary shared by all of them so
+    a pair of one model can be looked up in another. Codes follow the sort
+    order of the ids, so ordering pairs by code orders them by id. Already
+    encoded (int32) frames are returned as they are.
+    """
+    present = [np.asarray(id_df) for id_df in id_dfs if id_df is not None]
+    if all(ids.dtype == np.int32 for ids in present):
+        return tuple(None if id_df is None else np.asarray(id_df) for id_df in id_dfs)
+    codes, _ = pd.factorize(np.concatenate([ids.ravel() for ids in present]), sort=True)
+    codes = codes.astype(np.int32)
+    encoded, start = [], 0
+    for id_df in id_dfs:
+        if id_df is None:
+            encoded.append(None)
+            continue
+        size = np.asarray(id_df).size
+        encoded.append(codes[start:start + size].reshape(-1, 2))
+        start += size
+    return tuple(encoded)
+
+
+def _pair_keys(left_codes, right_codes):
+    """int64 key of each unordered pair of id codes: smaller code in the high 32 bits."""
+    left_codes = np.asarray(left_codes, dtype=np.int64)
+    right_codes = np.asarray(right_codes, dtype=np.int64)
+    return (np.minimum(left_codes, right_codes) << 32) | np.maximum(left_codes, right_codes)
+
+
+def _build_pair_index(ids):
+    """Sorted keys of the id code pairs (either orientation) and their rows; of repeated pairs the last row wins."""
+    keys = _pair_keys(ids[:, 0], ids[:, 1])
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    last = np.ones(keys.shape[0], dtype=bool)
+    last[:-1] = keys[1:] != keys[:-1]
+    return keys[last], order[last]
+
+
+def _expand_ranges(starts, stops):
+    """Concatenation of arange(start, stop) for every (start, stop)."""
+    lengths = stops - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + (np.arange(total) - offsets)
+
+
+def _group_pairs(sorted_codes):
+    """Positions (i, j), i < j, of all pairs inside runs of equal codes, in nested-loop order."""
+    n = sorted_codes.shape[0]
+    boundaries = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+    run_stops = np.concatenate((boundaries, [n]))
+    run_lengths = np.diff(np.concatenate(([0], run_stops)))
+    starts = np.arange(n)
+    stops = np.repeat(run_stops, run_lengths)
+    first = np.repeat(starts, stops - starts - 1)
+    second = _expand_ranges(starts + 1, stops)
+    return first, second
+
+
+def _resolve_triangles(model, P_M, id1, id2, idr, other_model, other_P_M):
+    """Resolve triangles (id1, id2, idr) in order, writing repairs into P_M / other_P_M.
+
+    A triangle only depends on earlier triangles touching the same entries,
+    so triangles are processed in waves: each wave holds every triangle whose
+    predecessors are all resolved, and is scored as one vectorized batch.
+    The result is identical to visiting the triangles one after another.
+    """
+    n_tri = id1.shape[0]
+    offset = 0 if other_P_M is P_M else P_M.shape[0]
+    has_r = idr >= 0
+    entries = [id1, id2, np.where(has_r, idr + offset, -1)]
+    if model.P_M is other_P_M:
+        # delta_L reads the baseline of id1/id2 from the array idr writes into
+        entries += [id1 + offset, id2 + offset]
+    keys = np.stack(entries, axis=1).ravel()
+    tris = np.repeat(np.arange(n_tri), len(entries))
+    valid = keys >= 0
+    keys, tris = keys[valid], tris[valid]
+    order = np.lexsort((tris, keys))
+    keys, tris = keys[order], tris[order]
+    distinct = np.ones(keys.shape[0], dtype=bool)
+    distinct[1:] = (keys[1:] != keys[:-1]) | (tris[1:] != tris[:-1])
+    keys, tris = keys[distinct], tris[distinct]
+
+    # chain every entry to the next triangle touching the same key
+    chained = keys[1:] == keys[:-1]
+    edge_src, edge_dst = tris[:-1][chained], tris[1:][chained]
+    edge_order = np.argsort(edge_src, kind='stable')
+    edge_dst = edge_dst[edge_order]
+    edge_ptr = np.searchsorted(edge_src[edge_order], np.arange(n_tri + 1))
+    indegree = np.bincount(edge_dst, minlength=n_tri)
+
+    ready = np.flatnonzero(indegree == 0)
+    while ready.size:
+        i1, i2, ir = id1[ready], id2[ready], idr[ready]
+        p1, p2 = P_M[i1], P_M[i2]
+        r_mask = ir >= 0
+        p_r = np.zeros(ready.size)
+        p_r[r_mask] = other_P_M[ir[r_mask]]
+        violated = p1*p2 > p_r
+        if violated.any():
+            i1, i2, ir, r_mask = i1[violated], i2[violated], ir[violated], r_mask[violated]
+            p1, p2, p_r = p1[violated], p2[violated], p_r[violated]
+            q1, q2, q_r = p_r/p2, p_r/p1, p1*p2
+            delta_ls = np.full((i1.shape[0], 3), -np.inf)
+            delta_ls[:, 0] = model.delta_L_batch(q1, i1)
+            delta_ls[:, 1] = model.delta_L_batch(q2, i2)
+            if r_mask.any():
+                delta_ls[r_mask, 2] = other_model.delta_L_batch(q_r[r_mask], ir[r_mask])
+            i_max = np.argmax(delta_ls, axis=1)
+            accept = delta_ls[np.arange(i_max.shape[0]), i_max] > -1e100
+            pick = accept & (i_max == 0)
+            P_M[i1[pick]] = q1[pick]
+            pick = accept & (i_max == 1)
+            P_M[i2[pick]] = q2[pick]
+            pick = accept & (i_max == 2)
+            other_P_M[ir[pick]] = q_r[pick]
+
+        successors = edge_dst[_expand_ranges(edge_ptr[ready], edge_ptr[ready + 1])]
+        if successors.size == 0:
+            break
+        successors, counts = np.unique(successors, return_counts=True)
+        indegree[successors] -= counts
+        ready = successors[indegree[successors] == 0]
+
+
 class ConvergenceMeter:
     def __init__(self, num_converged, rate_threshold,
                  diff_fn=lambda a, b: abs(a - b)):
@@ -84,24 +268,37 @@ class ZeroerModel:
             return norm.logpdf(s, loc=self.mu, scale=self.std)
 
 
-    def __init__(self, similarity_matrix, feature_names, y,id_df, c_bay,pi_M=None, hard=False):
+    def __init__(self, similarity_matrix, feature_names, y,id_df, c_bay,pi_M=None, hard=False, dtype=np.float64):
         self.c_bay = c_bay
-        self.y = get_y_init_given_threshold(pd.DataFrame(similarity_matrix))
-        self.X = np.array(similarity_matrix)
-        self.id_tuple_to_index = {}
+        #The caller's initial labels (get_y_init_given_threshold) seed the class parameters
+        self.y = np.asarray(y)
+        #X and the per-row vectors (P_M, P_U, Q_M, Q_U) are stored in dtype; sums and log-likelihoods are float64
+        self.X = np.array(similarity_matrix, dtype=dtype)
         if id_df is not None:
-            self.ids = id_df.values
-            for i in range(self.ids.shape[0]):
-                self.id_tuple_to_index[(self.ids[i,0],self.ids[i,1])] = i
-                self.id_tuple_to_index[(self.ids[i,1], self.ids[i,0])] = i
-
-        Mu_all = np.mean(self.X,axis=0)
-        self.Cov_all = np.dot(np.transpose(self.X - Mu_all),(self.X - Mu_all))/self.X.shape[0]
-        self.corr = pd.DataFrame(similarity_matrix).corr().values
-        self.sigma = np.zeros_like(self.corr)
-        for i in range(self.corr.shape[0]):
-            self.sigma[i,i] = np.std(self.X[:,i])
-        self.P_M = np.zeros(self.X.shape[0])  # M is class 1
+            #Id pairs are int32 codes (see encode_id_pairs), looked up with searchsorted on int64 keys
+            self.ids, = encode_id_pairs((id_df,))
+            self._pair_index = _build_pair_index(self.ids)
+
+        self._num_rows = self.X.shape[0]
+        self._num_cols = self.X.shape[1]
+        self._chol = None
+        self._moment_buffers = None
+        #Moments of both initial classes (and so of all rows) in one pass over X, shifted by the column means
+        Mu_all = np.mean(self.X,axis=0,dtype=np.float64)
+        is_M = (self.y == 1).astype(self.X.dtype)
+        N_M = np.sum(is_M)
+        N_U = self._num_rows - N_M
+        if N_M == 0 or N_U == 0:
+            raise ValueError("The initial labels must contain both matches and non-matches, got %d of %d rows labelled 1"
+                             % (N_M, self._num_rows))
+        (S1_M, S2_M), (S1_U, S2_U) = self._class_moments(is_M, 1. - is_M, Mu_all, Mu_all)
+        self.Cov_all = _centered_cov(S1_M + S1_U, S2_M + S2_U, self._num_rows, (S1_M + S1_U) / self._num_rows)
+        std_all = np.sqrt(np.diag(self.Cov_all))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            #Constant features get NaN correlations, as with DataFrame.corr
+            self.corr = np.clip(self.Cov_all / np.outer(std_all, std_all), -1., 1.)
+        self.sigma = np.diag(std_all)
+        self.P_M = np.zeros(self.X.shape[0], dtype=self.X.dtype)  # M is class 1
         self.Q_avg = 0
         self.feature_names = feature_names
 
@@ -111,109 +308,83 @@ class ZeroerModel:
             self.col_index_2_group_name.append(name.split("_")[0])
             self.group_name_2_col_indices[self.col_index_2_group_name[-1]].append(i_col)
         self.group_names = list(set(self.col_index_2_group_name))
+        #m_step only keeps the correlations between different features of the same attribute
+        group_codes, _ = pd.factorize(np.array(self.col_index_2_group_name))
+        same_group = group_codes[:, None] == group_codes[None, :]
+        np.fill_diagonal(same_group, False)
+        self._group_corr = np.where(same_group, self.corr, 0.)
 
         if pi_M is None:
-            pi_M = Counter(list(y))[1] / float(len(y))
+            pi_M = N_M / float(self._num_rows)
 
         self._hard = hard
-        self._num_rows = self.X.shape[0]
-        self._num_cols = self.X.shape[1]
-        self._labels = list(sorted(np.unique(y)))
+        self._labels = list(sorted(np.unique(self.y)))
         self.y_step = y
 
         self.pi_M = pi_M
+        self._cache_log_priors()
         self.pi_M_l = pi_M
         self.pi_M_r = pi_M
-        self.params = []
-        self.Mu_M = np.zeros((self._num_cols,))
-        self.Mu_U = np.zeros((self._num_cols,))
-        self.Cov_M = np.zeros((self._num_cols,self._num_cols))
-        self.Cov_U = np.zeros((self._num_cols,self._num_cols))
-        for i in range(self._num_cols):
-            self.params.append(self.fit_conditional_parameters(i))
-            self.Mu_U[i] = self.params[-1][0].mu
-            self.Mu_M[i] = self.params[-1][1].mu
-            self.Cov_U[i,i] = self.params[-1][0].std**2
-            self.Cov_M[i,i] = self.params[-1][1].std**2
+        #Per column and class, the mean and variance a one-component GaussianMixture fit gives (reg_covar 1e-6)
+        self.Mu_M = Mu_all + S1_M / N_M
+        self.Mu_U = Mu_all + S1_U / N_U
+        self.Cov_M = np.diag(np.diag(_centered_cov(S1_M, S2_M, N_M, S1_M / N_M)) + 1e-6)
+        self.Cov_U = np.diag(np.diag(_centered_cov(S1_U, S2_U, N_U, S1_U / N_U)) + 1e-6)
+        std_M = np.sqrt(np.diag(self.Cov_M))
+        std_U = np.sqrt(np.diag(self.Cov_U))
+        self.params = [{0: self.Gaussian(mu=self.Mu_U[i], std=std_U[i]), 1: self.Gaussian(mu=self.Mu_M[i], std=std_M[i])}
+                       for i in range(self._num_cols)]
         self.P_M_2_dimen = None
         self.log_P_M_2_dimen = None
         self.log_P_U_2_dimen = None
 
 
-    def get_class_wise_scores(self, i_cols):
-        class_wise_scores = dict()
-        for label in self._labels:
-            class_wise_scores[label] = \
-                self.X[np.where(self.y == label), i_cols]
-
-        return class_wise_scores
-
-
-    def fit_conditional_parameters(self, i):
-        class_wise_scores = self.get_class_wise_scores(i)
-
-        class_wise_parameters = dict()
-        for label in self._labels:
-            gmm = GaussianMixture(n_components=1)
-            gmm.fit(class_wise_scores[label].reshape(-1, 1))
-
-            class_wise_parameters[label] = \
-                self.Gaussian(mu=gmm.means_.flatten()[0],
-                              std=np.sqrt(gmm.covariances_.flatten()[0]))
-
-        return class_wise_parameters
-
-
     def e_step(self, model_l = None,model_r = None):
         self.model_l = model_l
         self.model_r = model_r
         N = self._num_rows
         M = self._num_cols
 
-        reg_cov = 1e-8 * np.identity(len(self.X[0]))
-        self.Cov_M += reg_cov
-        self.Cov_U += reg_cov
-
-        min_eig = np.min(np.real(np.linalg.eigvals(self.Cov_M)))
-        if min_eig < 0:
-            self.Cov_M -= 10 * min_eig * np.eye(*self.Cov_M.shape)
-            #self.Cov_M += reg_cov
-        min_eig = np.min(np.real(np.linalg.eigvals(self.Cov_U)))
-        if min_eig < 0:
-            self.Cov_U -= 10 * min_eig * np.eye(*self.Cov_U.shape)
-            #self.Cov_U += reg_cov
-        log_prods_dup = multivariate_normal.logpdf(self.X, mean=self.Mu_M, cov=self.Cov_M,allow_singular=True)
-        log_prods_non_dup = multivariate_normal.logpdf(self.X, mean=self.Mu_U, cov=self.Cov_U,allow_singular=True)
+        chol_M, chol_U = self._factorize()
+        log_prods_dup = _gaussian_logpdf(self.X, self.Mu_M, chol_M)
+        log_prods_non_dup = _gaussian_logpdf(self.X, self.Mu_U, chol_U)
 
         pi_M = self.pi_M
         pi_U = 1 - pi_M
 
         prob_non_dup_over_dup = np.exp(np.clip(log_prods_non_dup - log_prods_dup, -500, 500))
 
-        self.Q_M = log_prods_dup
-        self.Q_U = log_prods_non_dup
+        self.Q_M = log_prods_dup.astype(self.X.dtype, copy=False)
+        self.Q_U = log_prods_non_dup.astype(self.X.dtype, copy=False)
 
 
-        self.P_M = pi_M/ (pi_M + pi_U * prob_non_dup_over_dup)
+        self.P_M = (pi_M/ (pi_M + pi_U * prob_non_dup_over_dup)).astype(self.X.dtype, copy=False)
+        #Posteriors below the smallest normal number (1e-38 in float32) would make the M-step crawl through subnormals
+        self.P_M[self.P_M < np.finfo(self.X.dtype).tiny] = 0
         self.P_U = 1-self.P_M
         if self._hard:
             self.P_M = np.round(np.clip(self.P_M, 0., 1.))
+        self._cache_log_priors()
+
+    def _factorize(self):
+        """Cholesky factors of Cov_M and Cov_U, computed once per pair of covariances and shared with predict_PM."""
+        if self._chol is None:
+            reg_cov = 1e-8 * np.identity(self._num_cols)
+            self.Cov_M += reg_cov
+            self.Cov_U += reg_cov
+            self._chol = (_cholesky(self.Cov_M), _cholesky(self.Cov_U))
+        return self._chol
 
     def free_energy(self):
-        return self.P_M*(np.log(self.pi_M+DEL)-np.log(self.P_M+DEL)+self.Q_M)+self.P_U*(np.log(1-self.pi_M+DEL)-np.log(self.P_U+DEL)+self.Q_U)
+        #In float64: DEL underflows to 0 in float32
+        P_M, P_U = self.P_M.astype(np.float64), self.P_U.astype(np.float64)
+        return P_M*(np.log(self.pi_M+DEL)-np.log(P_M+DEL)+self.Q_M)+P_U*(np.log(1-self.pi_M+DEL)-np.log(P_U+DEL)+self.Q_U)
 
     def predict_PM(self,X_test):
-        reg_cov = 1e-8 * np.identity(len(self.X[0]))
-        self.Cov_M += reg_cov
-        self.Cov_U += reg_cov
-        min_eig = np.min(np.real(np.linalg.eigvals(self.Cov_M)))
-        if min_eig < 0:
-            self.Cov_M -= 10 * min_eig * np.eye(*self.Cov_M.shape)
-        min_eig = np.min(np.real(np.linalg.eigvals(self.Cov_U)))
-        if min_eig < 0:
-            self.Cov_U -= 10 * min_eig * np.eye(*self.Cov_U.shape)
-        log_prods_dup = multivariate_normal.logpdf(X_test, mean=self.Mu_M, cov=self.Cov_M)
-        log_prods_non_dup = multivariate_normal.logpdf(X_test, mean=self.Mu_U, cov=self.Cov_U)
+        chol_M, chol_U = self._factorize()
+        X_test = np.asarray(X_test, dtype=self.X.dtype)
+        log_prods_dup = _gaussian_logpdf(X_test, self.Mu_M, chol_M)
+        log_prods_non_dup = _gaussian_logpdf(X_test, self.Mu_U, chol_U)
 
         pi_M = self.pi_M
         pi_U = 1 - pi_M
@@ -225,127 +396,59 @@ class ZeroerModel:
         P_M_test = np.round(np.clip(P_M_test, 0., 1.))
         return P_M_test
 
-    def enforce_transitivity(self, P_M, ids, id_tuple_to_index, model_l, model_r,LR_dup_free=False,LR_identical=False):
-        model_l_P_M=None
-        model_r_P_M=None
-        if model_l is not None:
-            model_l_P_M = model_l.P_M
-            model_r_P_M = model_r.P_M
-            id_tuple_to_index_l = model_l.id_tuple_to_index
-            id_tuple_to_index_r = model_r.id_tuple_to_index
-        P_M = P_M.copy()
-        pred_tuples = []
-
-        for i in range(P_M.shape[0]):
-            if P_M[i]>0.5:
-                pred_tuples.append((ids[i,0],ids[i,1]))
-        pred_tuples = sorted(pred_tuples)
-
-        for i in range(len(pred_tuples)):
-            for j in range(i+1, len(pred_tuples)):
-                if pred_tuples[j][0] == pred_tuples[i][0]:
-                    p1 = P_M[id_tuple_to_index[pred_tuples[i]]]
-                    p2 = P_M[id_tuple_to_index[pred_tuples[j]]]
-                    p_r = 0
-                    id1 = id_tuple_to_index[pred_tuples[i]]
-                    id2 = id_tuple_to_index[pred_tuples[j]]
-                    if LR_dup_free:
-                        p_r = 0
-                        idr = -1
-                    elif LR_identical:
-                        if (pred_tuples[i][1], pred_tuples[j][1]) not in id_tuple_to_index:
-                            p_r = 0
-                            idr = -1
-                        else:
-                            p_r = P_M[id_tuple_to_index[(pred_tuples[i][1],pred_tuples[j][1])]]
-                            idr = id_tuple_to_index[(pred_tuples[i][1],pred_tuples[j][1])]
-                    elif model_r_P_M is not None:
-                            if (pred_tuples[i][1], pred_tuples[j][1]) not in id_tuple_to_index_r:
-                                p_r = 0
-                                idr = -1
-                            else:
-                                p_r = model_r_P_M[id_tuple_to_index_r[(pred_tuples[i][1],pred_tuples[j][1])]]
-                                idr = id_tuple_to_index_r[(pred_tuples[i][1],pred_tuples[j][1])]
-
-                    if p1*p2 > p_r:
-                        delta_ls = [self.delta_L(p_r/p2,id1),self.delta_L(p_r/p1,id2)]
-                        if idr != -1:
-                            if LR_identical:
-                                delta_ls.append(self.delta_L(p1 * p2, idr))
-                            else:
-                                delta_ls.append(model_r.delta_L(p1 * p2, idr))
-                        i_max = np.argmax(delta_ls)
-                        if delta_ls[i_max]>-1e100:
-                            if i_max == 0:
-                                P_M[id1] = p_r / p2
-                            elif i_max == 1:
-                                P_M[id2] = p_r / p1
-                            elif i_max == 2:
-                                if LR_identical:
-                                    P_M[idr] = p1 * p2
-                                else:
-                                    model_r_P_M[idr] = p1*p2
-                else:
-                    break
+    def enforce_transitivity(self, P_M, ids, model_l, model_r,LR_dup_free=False,LR_identical=False):
+        """Repair violated triangles among the predicted matches of P_M.
 
-        pred_tuples = sorted(pred_tuples,key=lambda x:(x[1],x[0]))
-        for i in range(len(pred_tuples)):
-            for j in range(i+1, len(pred_tuples)):
-                if pred_tuples[j][1] == pred_tuples[i][1]:
-                    p1 = P_M[id_tuple_to_index[pred_tuples[i]]]
-                    p2 = P_M[id_tuple_to_index[pred_tuples[j]]]
-                    p_l=0
-                    id1 = id_tuple_to_index[pred_tuples[i]]
-                    id2 = id_tuple_to_index[pred_tuples[j]]
-                    if LR_dup_free:
-                        p_l = 0
-                        idl = -1
-                    elif LR_identical:
-                        if (pred_tuples[i][0], pred_tuples[j][0]) not in id_tuple_to_index:
-                            p_l = 0
-                            idl = -1
-                        else:
-                            p_l = P_M[id_tuple_to_index[(pred_tuples[i][0],pred_tuples[j][0])]]
-                            idl = id_tuple_to_index[(pred_tuples[i][0],pred_tuples[j][0])]
-                    elif model_l_P_M is not None:
-                            if (pred_tuples[i][0], pred_tuples[j][0]) not in id_tuple_to_index_l:
-                                p_l = 0
-                                idl = -1
-                            else:
-                                p_l = model_l_P_M[id_tuple_to_index_l[(pred_tuples[i][0],pred_tuples[j][0])]]
-                                idl = id_tuple_to_index_l[(pred_tuples[i][0],pred_tuples[j][0])]
-                                #p_l = 0
-                                #idl = -1
-                    if p1*p2 > p_l:
-                        delta_ls = [self.delta_L(p_l / p2, id1), self.delta_L(p_l / p1, id2)]
-                        if idl != -1:
-                            if LR_identical:
-                                delta_ls.append(self.delta_L(p1 * p2, idl))
-                            else:
-                                delta_ls.append(model_l.delta_L(p1 * p2, idl))
-                        i_max = np.argmax(delta_ls)
-                        if delta_ls[i_max]>-1e100:
-                            if i_max == 0:
-                                P_M[id1] = p_l / p2
-                            elif i_max == 1:
-                                P_M[id2] = p_l / p1
-                            elif i_max == 2:
-                                if LR_identical:
-                                    P_M[idl] = p1*p2
-                                else:
-                                    model_l_P_M[idl] = p1 * p2
-                else:
-                    break
-        if model_r_P_M is not None:
-            model_l.P_M = model_l_P_M
-            model_r.P_M = model_r_P_M
+        Predicted matches are bucketed by shared left id (then by shared
+        right id); every pair inside a bucket forms a triangle with the
+        corresponding pair in model_r (model_l), or in this model when
+        LR_identical. Triangles are resolved with the same delta_L
+        arbitration and in the same order as a sequential sweep, but all
+        triangles that do not depend on each other are scored together.
+        """
+        P_M = P_M.copy()
+        pred = np.flatnonzero(P_M > 0.5)
+        if pred.size < 2:
+            return P_M
+        #Codes are in id order, so sorting by code visits the pairs in id order
+        pred_l = ids[pred, 0]
+        pred_r = ids[pred, 1]
+        pos = self._lookup_pairs(pred_l, pred_r)
+
+        passes = ((np.lexsort((pred_r, pred_l)), pred_l, pred_r, model_r),
+                  (np.lexsort((pred_l, pred_r)), pred_r, pred_l, model_l))
+        for order, group_codes, other_ids, other_model in passes:
+            first, second = _group_pairs(group_codes[order])
+            if first.size == 0:
+                continue
+            id1 = pos[order[first]]
+            id2 = pos[order[second]]
+            if LR_dup_free:
+                other_model = None
+            elif LR_identical:
+                other_model = self
+            if other_model is None:
+                idr = np.full(first.size, -1)
+                other_P_M = P_M
+            else:
+                idr = other_model._lookup_pairs(other_ids[order[first]], other_ids[order[second]])
+                other_P_M = P_M if LR_identical else other_model.P_M
+            _resolve_triangles(self, P_M, id1, id2, idr, other_model, other_P_M)
         return P_M
 
+    def _lookup_pairs(self, left_ids, right_ids):
+        """Row index of each (left, right) id code pair in either orientation, -1 if absent."""
+        keys, rows = self._pair_index
+        queries = _pair_keys(left_ids, right_ids)
+        if keys.shape[0] == 0:
+            return np.full(queries.shape[0], -1)
+        found = np.minimum(np.searchsorted(keys, queries), keys.shape[0] - 1)
+        return np.where(keys[found] == queries, rows[found], -1)
+
     def m_step(self):
         N = self._num_rows
         M = self._num_cols
 
-        X = self.X
         P_M = self.P_M
         P_U = 1. - P_M
 
@@ -353,27 +456,27 @@ class ZeroerModel:
             P_M = P_M.astype(int)
             P_U = P_U.astype(int)
 
-        N_M = np.sum(P_M, axis=0)
+        N_M = np.sum(P_M, axis=0, dtype=np.float64)
         N_U = N - N_M
 
         self.pi_M = N_M / N
 
 
-        P_M = P_M.reshape(N, 1)
-        P_U = P_U.reshape(N, 1)
-
-        self.Mu_M = np.sum(P_M * X, axis=0) / (N_M + DEL)
-        self.Mu_U = np.sum(P_U * X, axis=0) / (N_U + DEL)
+        #Means and covariances from the sufficient statistics of X shifted by the previous means
+        shift_M, shift_U = self.Mu_M, self.Mu_U
+        (S1_M, S2_M), (S1_U, S2_U) = self._class_moments(P_M, P_U, shift_M, shift_U)
+        dMu_M = S1_M / (N_M + DEL)
+        dMu_U = S1_U / (N_U + DEL)
+        self.Mu_M = shift_M + dMu_M
+        self.Mu_U = shift_U + dMu_U
 
         smooth_factor = abs((self.Mu_M - self.Mu_U))**2
 
-        std_M = (np.sqrt(np.sum(
-            P_M * ((X - np.tile(self.Mu_M, (N, 1))) ** 2), axis=0) / (N_M + DEL))) + 1e-100
-        std_U = (np.sqrt(np.sum(
-            P_U * ((X - np.tile(self.Mu_U, (N, 1))) ** 2), axis=0) / (N_U + DEL))) + 1e-100
+        Cov_M = _centered_cov(S1_M, S2_M, N_M, dMu_M)
+        Cov_U = _centered_cov(S1_U, S2_U, N_U, dMu_U)
 
-        Cov_M = np.dot(np.transpose(self.X - self.Mu_M),P_M*(self.X - self.Mu_M))/(N_M + DEL)
-        Cov_U = np.dot(np.transpose(self.X - self.Mu_U),P_U*(self.X - self.Mu_U))/(N_U + DEL)
+        std_M = np.sqrt(np.diag(Cov_M)) + 1e-100
+        std_U = np.sqrt(np.diag(Cov_U)) + 1e-100
 
         a = np.diag(Cov_M)
         b = np.diag(Cov_U)
@@ -392,22 +495,44 @@ class ZeroerModel:
         kappas[kappas<0] = 0
         kappas[kappas>1] = 1
         kappas = np.nan_to_num(kappas,posinf=0,neginf=0)
-        self.Cov_M = np.zeros_like(Cov_M)
-        self.Cov_U = np.zeros_like(Cov_U)
-
-        for g_name in self.group_names:
-            i_cols = self.group_name_2_col_indices[g_name]
-
-            for col_1 in i_cols:
-                for col_2 in i_cols:
-                    if col_2 == col_1:
-                        self.Cov_M[col_1, col_2] = Cov_M[col_1, col_2]+kappas[col_1]
-                        self.Cov_U[col_1, col_2] = Cov_U[col_1, col_2]+kappas[col_1]
-                    else:
-                        self.Cov_M[col_1, col_2] = self.corr[col_1,col_2]*std_M[col_1]*std_M[col_2]
-                        self.Cov_U[col_1, col_2] = self.corr[col_1,col_2]*std_U[col_1]*std_U[col_2]
+        #Covariances of features of the same attribute are corr*std*std, the variances get kappa, the rest is 0
+        self.Cov_M = self._group_corr * std_M[:, None] * std_M[None, :]
+        self.Cov_U = self._group_corr * std_U[:, None] * std_U[None, :]
+        diag = np.diag_indices_from(Cov_M)
+        self.Cov_M[diag] = Cov_M[diag] + kappas
+        self.Cov_U[diag] = Cov_U[diag] + kappas
+        self._chol = None
+
+    def _class_moments(self, P_M, P_U, shift_M, shift_U):
+        """
+        Sufficient statistics (sum of w (x - shift), sum of w (x - shift)(x - shift)^T)
+        of both classes, in float64 and in one pass over X: per chunk of rows
+        one multiply into a preallocated buffer and one BLAS product per
+        class. Shifting by the class means of the previous step keeps the
+        second moments from cancelling when they are centered.
+        """
+        M = self._num_cols
+        moments = [(np.zeros(M), np.zeros((M, M))), (np.zeros(M), np.zeros((M, M)))]
+        if self._moment_buffers is None:
+            rows = min(MOMENT_CHUNK_ROWS, self._num_rows)
+            self._moment_buffers = (np.empty((rows, M), dtype=self.X.dtype), np.empty((rows, M), dtype=self.X.dtype))
+        centered, weighted = self._moment_buffers
+        for start in range(0, self._num_rows, MOMENT_CHUNK_ROWS):
+            X_chunk = self.X[start:start + MOMENT_CHUNK_ROWS]
+            n = X_chunk.shape[0]
+            for (S1, S2), w, shift in zip(moments, (P_M, P_U), (shift_M, shift_U)):
+                Y = np.subtract(X_chunk, shift, out=centered[:n])
+                wY = np.multiply(Y, w[start:start + n, None], out=weighted[:n])
+                S1 += wY.sum(axis=0, dtype=np.float64)
+                S2 += np.dot(Y.T, wY)
+        return moments
+
+    def _cache_log_priors(self):
+        self.log_pi_M = np.log(self.pi_M+DEL)
+        self.log_pi_U = np.log(1-self.pi_M+DEL)
+
     def L(self,q,i):
-        return q*(np.log(self.pi_M+DEL) + self.Q_M[i] - np.log(q+DEL)) +(1-q)*(np.log(1-self.pi_M+DEL)+self.Q_U[i]-np.log(1-q+DEL))
+        return q*(self.log_pi_M + self.Q_M[i] - np.log(q+DEL)) +(1-q)*(self.log_pi_U+self.Q_U[i]-np.log(1-q+DEL))
 
     def delta_L(self,q,i):
         delta = self.L(q,i) - self.L(self.P_M[i],i)
@@ -415,6 +540,39 @@ class ZeroerModel:
             return -1e200
         return delta
 
+    def L_batch(self, q, idx):
+        """L for arrays of candidate posteriors q at row indices idx."""
+        q = np.asarray(q, dtype=float)
+        idx = np.asarray(idx)
+        return q*(self.log_pi_M + self.Q_M[idx] - np.log(q+DEL)) +(1-q)*(self.log_pi_U+self.Q_U[idx]-np.log(1-q+DEL))
+
+    def delta_L_batch(self, q, idx):
+        """delta_L for arrays of candidate posteriors q at row indices idx."""
+        idx = np.asarray(idx)
+        delta = self.L_batch(q, idx) - self.L_batch(self.P_M[idx], idx)
+        delta[delta > 0.00001] = -1e200
+        return delta
+
+    def get_params(self):
+        return {"feature_names": list(self.feature_names), "pi_M": self.pi_M,
+                "Mu_M": self.Mu_M.copy(), "Mu_U": self.Mu_U.copy(),
+                "Cov_M": self.Cov_M.copy(), "Cov_U": self.Cov_U.copy()}
+
+    def set_params(self, params):
+        """Warm start from get_params() of an earlier run; returns False if the features differ."""
+        names = list(self.feature_names)
+        if sorted(params["feature_names"]) != sorted(names):
+            return False
+        order = [params["feature_names"].index(name) for name in names]
+        self.pi_M = params["pi_M"]
+        self.Mu_M = np.asarray(params["Mu_M"])[order]
+        self.Mu_U = np.asarray(params["Mu_U"])[order]
+        self.Cov_M = np.asarray(params["Cov_M"])[np.ix_(order, order)]
+        self.Cov_U = np.asarray(params["Cov_U"])[np.ix_(order, order)]
+        self._chol = None
+        self._cache_log_priors()
+        return True
+
     def save_model(self, filepath):
         pickle.dump(self, open(filepath, 'wb'))
 
@@ -428,14 +586,22 @@ class ZeroerModel:
                y_true=None,
                pi_M=None,
                hard=False,
-               max_iter=40):
+               max_iter=40,
+               init_params=None,
+               dtype=np.float64):
         sims, sims_l, sims_r = similarity_matrixs
         y_init,y_init_l,y_init_r = y_inits
-        id_df, id_df_l, id_df_r = id_dfs
-        model = cls(sims, feature_names,y_init,id_df,pi_M=pi_M, hard=hard,c_bay=c_bay)
+        #One id dictionary for the three models, so LxR pairs can be looked up in the LxL/RxR models
+        id_df, id_df_l, id_df_r = encode_id_pairs(id_dfs)
+        model = cls(sims, feature_names,y_init,id_df,pi_M=pi_M, hard=hard,c_bay=c_bay,dtype=dtype)
+        if init_params is not None:
+            if model.set_params(init_params):
+                print("Warm-starting EM from previous parameters")
+            else:
+                print("Previous parameters use different features, starting EM from scratch")
         if run_trans and LR_dup_free==False and LR_identical==False:
-            model_l = cls(sims_l, feature_names,y_init_l,id_df_l,c_bay=c_bay)
-            model_r = cls(sims_r, feature_names,y_init_r,id_df_r,c_bay=c_bay)
+            model_l = cls(sims_l, feature_names,y_init_l,id_df_l,c_bay=c_bay,dtype=dtype)
+            model_r = cls(sims_r, feature_names,y_init_r,id_df_r,c_bay=c_bay,dtype=dtype)
 
         convergence = ConvergenceMeter(10, 0.01, diff_fn=lambda a, b: np.linalg.norm(a - b))
 
@@ -448,11 +614,11 @@ class ZeroerModel:
                         model_l.e_step()
                     for i in range(4):
                         if LR_dup_free == False and LR_identical==False:
-                            model_l.P_M = model_l.enforce_transitivity(model_l.P_M, model_l.ids, model_l.id_tuple_to_index, model_l, model_l)
-                            model_r.P_M = model_r.enforce_transitivity(model_r.P_M, model_r.ids, model_r.id_tuple_to_index, model_r, model_r)
-                            model.P_M = model.enforce_transitivity(model.P_M, model.ids, model.id_tuple_to_index, model_l, model_r)
+                            model_l.P_M = model_l.enforce_transitivity(model_l.P_M, model_l.ids, model_l, model_l)
+                            model_r.P_M = model_r.enforce_transitivity(model_r.P_M, model_r.ids, model_r, model_r)
+                            model.P_M = model.enforce_transitivity(model.P_M, model.ids, model_l, model_r)
                         else:
-                            model.P_M = model.enforce_transitivity(model.P_M, model.ids, model.id_tuple_to_index, None, None,LR_dup_free,LR_identical)
+                            model.P_M = model.enforce_transitivity(model.P_M, model.ids, None, None,LR_dup_free,LR_identical)
                 model.m_step()
                 if run_trans and LR_dup_free == False and LR_identical==False:
                     model_r.m_step()
@@ -0,0 +1,133 @@
+import argparse
+import time
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from blocking_functions import GENERIC_MAX_CANDIDATES, MinHashIndex, OverlapIndex, pick_blocking_attribute
+from data_loading_helper.data_loader import load_tables
+
+""" Sweep of blocking configurations on one dataset, in one process: the
+tables are loaded once and each blocking attribute is tokenized into an
+OverlapIndex (and MinHash signatures) once, then every configuration of the
+grid is evaluated on those indexes. Configurations are word overlap sizes,
+LSH Jaccard thresholds and two-stage combinations (block on an attribute,
+then keep the pairs that also share filter_overlap_size words of a filter
+attribute, as em.OverlapBlocker().block_candset). Prints candidate count,
+reduction ratio and recall (pair completeness) of each.
+
+python sweep_blocking.py beer --attrs Beer_Name --overlap_sizes 1 2 3 4 \
+    --filter_attrs Brew_Factory_Name --filter_overlap_sizes 1 2 --thresholds 0.3 0.4 0.5 --allow_missing
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("dataset", type=str)
+parser.add_argument("--attrs", type=str, nargs="+", default=None,
+                    help="attributes to block on (default: the one picked by pick_blocking_attribute)")
+parser.add_argument("--overlap_sizes", type=int, nargs="*", default=[1, 2, 3, 4])
+parser.add_argument("--thresholds", type=float, nargs="*", default=[], help="Jaccard thresholds of MinHash/LSH blocking")
+parser.add_argument("--filter_attrs", type=str, nargs="*", default=[], help="second-stage attributes of two-stage blocking")
+parser.add_argument("--filter_overlap_sizes", type=int, nargs="*", default=[1, 2])
+parser.add_argument("--q_val", type=int, default=None, help="block on q-grams instead of words")
+parser.add_argument("--allow_missing", type=bool, default=False, nargs="?", const=True)
+parser.add_argument("--LR_identical", type=bool, default=False, nargs="?", const=True)
+parser.add_argument("--max_candidates", type=int, default=GENERIC_MAX_CANDIDATES,
+                    help="configurations with more candidates are reported as over budget and skipped")
+parser.add_argument("--output", type=str, default=None, help="also write the table to this CSV file")
+
+data_path = "datasets"
+
+
+def load_dataset(dataset_name, LR_identical=False):
+    dataset_path = join(data_path, dataset_name)
+    with open(join(dataset_path, "metadata.txt")) as f:
+        names = [line.strip() for line in f if line.strip()]
+    label_name = names[1] if LR_identical else names[2]
+    A, B, G = load_tables(join(dataset_path, names[0]), join(dataset_path, names[0 if LR_identical else 1]),
+                          join(dataset_path, label_name))
+    if G is None:
+        raise ValueError("Recall needs the matches file of " + dataset_name)
+    return A, B, G
+
+
+def gold_keys(A, B, G):
+    """Matches as l_pos * len(B) + r_pos keys, comparable with the pairs of the indexes."""
+    l_pos = pd.Index(A["id"].astype(str)).get_indexer(G.iloc[:, 0].astype(str))
+    r_pos = pd.Index(B["id"].astype(str)).get_indexer(G.iloc[:, 1].astype(str))
+    known = (l_pos >= 0) & (r_pos >= 0)
+    return np.unique(l_pos[known].astype(np.int64) * len(B) + r_pos[known])
+
+
+class Sweep:
+    def __init__(self, A, B, G, args):
+        self.A, self.B, self.args = A, B, args
+        self.gold = gold_keys(A, B, G)
+        self.n_matches = len(G.iloc[:, :2].astype(str).drop_duplicates())
+        self._indexes, self._minhashes = {}, {}
+        self.rows = []
+
+    def index(self, attr, word_level=True, q_val=None, rem_stop_words=False):
+        key = (attr, word_level, q_val, rem_stop_words)
+        if key not in self._indexes:
+            start = time.time()
+            self._indexes[key] = OverlapIndex(self.A, self.B, attr, attr, word_level, q_val, rem_stop_words)
+            print(f"[SWEEP] Indexed {attr} in {time.time() - start:.2f}s", flush=True)
+        return self._indexes[key]
+
+    def minhash(self, attr):
+        if attr not in self._minhashes:
+            self._minhashes[attr] = MinHashIndex(self.index(attr, self.args.q_val is None, self.args.q_val))
+        return self._minhashes[attr]
+
+    def record(self, method, attr, setting, pairs, seconds, filter_attr=None, filter_setting=None):
+        row = {"method": method, "attribute": attr, "setting": setting, "filter": filter_attr,
+               "filter_setting": filter_setting, "candidates": None, "reduction_ratio": None, "recall": None,
+               "matches_found": None, "seconds": round(seconds, 3)}
+        if pairs is not None:
+            l_idx, r_idx = pairs
+            found = int(np.isin(self.gold, l_idx.astype(np.int64) * len(self.B) + r_idx).sum())
+            row.update(candidates=len(l_idx), reduction_ratio=1.0 - len(l_idx) / (len(self.A) * len(self.B)),
+                       recall=found / self.n_matches if self.n_matches else None, matches_found=found)
+        self.rows.append(row)
+        print(f"[SWEEP] {method} {attr} {setting}" + (f" + {filter_attr} {filter_setting}" if filter_attr else "")
+              + (": over budget" if pairs is None else f": {row['candidates']:,} candidates, recall {row['recall']}"),
+              flush=True)
+
+    def run(self, attrs):
+        args = self.args
+        for attr in attrs:
+            index = self.index(attr, args.q_val is None, args.q_val)
+            for overlap_size in args.overlap_sizes:
+                start = time.time()
+                pairs = index.candidates(overlap_size, args.allow_missing, max_candidates=args.max_candidates)
+                self.record("overlap", attr, overlap_size, pairs, time.time() - start)
+                if pairs is None:
+                    continue
+                for filter_attr in args.filter_attrs:
+                    filter_index = self.index(filter_attr)
+                    start = time.time()
+                    overlap = filter_index.overlap(*pairs)
+                    for filter_size in args.filter_overlap_sizes:
+                        #As block_candset: a missing filter value keeps the pair only with allow_missing
+                        keep = (overlap >= filter_size) | ((overlap < 0) & args.allow_missing)
+                        self.record("overlap", attr, overlap_size, (pairs[0][keep], pairs[1][keep]),
+                                    time.time() - start, filter_attr, filter_size)
+            for threshold in args.thresholds:
+                start = time.time()
+                pairs = self.minhash(attr).candidates(threshold, max_candidates=args.max_candidates)
+                self.record("lsh", attr, threshold, pairs, time.time() - start)
+        return pd.DataFrame(self.rows)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    start = time.time()
+    A, B, G = load_dataset(args.dataset, args.LR_identical)
+    print(f"[SWEEP] {args.dataset}: {len(A)} x {len(B)} records, {len(G)} matches, loaded in {time.time() - start:.2f}s")
+    attrs = args.attrs or [pick_blocking_attribute(A, B)]
+    results = Sweep(A, B, G, args).run(attrs)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
@@ -8,6 +8,9 @@ import numpy as np
 from pathlib import Path
 from sklearn.metrics import precision_score, recall_score, f1_score
 
+from data_loading_helper.feature_cache import latest_feature_dir
+from data_loading_helper.feature_store import load_features
+
 def test_thresholds(dataset_name="beer", data_path="datasets"):
     dataset_path = Path(data_path) / dataset_name
     
@@ -20,17 +23,16 @@ def test_thresholds(dataset_name="beer", data_path="datasets"):
     pred_df = pd.read_csv(pred_file)
     
     # 读取真实标签
-    features_file = dataset_path / "candset_features_df.csv"
-    if features_file.exists():
-        features_df = pd.read_csv(features_file, index_col=0)
-        if 'gold' in features_df.columns:
-            y_true = features_df['gold'].values
-        else:
-            print("❌ 没有找到 gold 标签")
-            return
-    else:
+    try:
+        features_df = load_features(latest_feature_dir(str(dataset_path)), "candset_features_df")
+    except FileNotFoundError:
         print("❌ 没有找到特征文件")
         return
+    if 'gold' in features_df.columns:
+        y_true = features_df['gold'].values
+    else:
+        print("❌ 没有找到 gold 标签")
+        return
     
     # 获取概率值
     y_proba = pred_df['pred'].values
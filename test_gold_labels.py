@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_loading_helper.blocking_report import is_match, pair_completeness
+from data_loading_helper.candidate_set import CandidateSet
+
+
+#Tables keep their ids as strings (read_table), the matches file is read with inferred dtypes
+def _tables():
+    ltable_df = pd.DataFrame({"id": np.array(["007", "8", "9"], dtype=object)})
+    rtable_df = pd.DataFrame({"id": np.array(["1", "2", "3"], dtype=object)})
+    candset = CandidateSet(ltable_df, rtable_df, [0, 1, 2, 0], [0, 1, 2, 2])
+    return ltable_df, rtable_df, candset
+
+
+@pytest.mark.parametrize("matches_df", [
+    pd.DataFrame({"ltable_id": [7, 8], "rtable_id": [1, 2]}),
+    pd.DataFrame({"ltable_id": [7.0, 8.0], "rtable_id": [1.0, 2.0]}),
+    pd.DataFrame({"ltable_id": ["7", "8"], "rtable_id": ["1", "2"]}),
+    pd.DataFrame({"ltable_id": ["007", "8"], "rtable_id": ["1", "2"]}),
+])
+def test_report_and_gold_agree(matches_df):
+    pytest.importorskip("py_entitymatching")
+    from data_loading_helper.feature_extraction import add_labels_to_candset
+
+    ltable_df, rtable_df, candset = _tables()
+    expected = np.array([True, True, False, False])
+    assert (is_match(candset.ltable_ids, candset.rtable_ids, matches_df) == expected).all()
+    assert pair_completeness(candset, matches_df) == (1.0, 2, 2)
+    for labels_df in (matches_df.copy(), matches_df.astype(str)):
+        candset_df = add_labels_to_candset(labels_df, candset.to_frame(), ltable_df, rtable_df)
+        assert (candset_df["gold"].values == expected).all()
+
+
+def test_pairs_keep_their_orientation():
+    matches_df = pd.DataFrame({"ltable_id": ["1"], "rtable_id": ["2"]})
+    ids = np.array(["1", "2"], dtype=object)
+    assert is_match(ids, ids[::-1], matches_df).tolist() == [True, False]
@@ -1,3 +1,5 @@
+import pickle
+
 import numpy as np
 import pandas as pd
 from sklearn.metrics import precision_score, recall_score, f1_score
@@ -14,7 +16,8 @@ def get_results(true_labels, predicted_labels):
     return p, r, f1
 
 
-def run_zeroer(similarity_features_df, similarity_features_lr,id_dfs,true_labels,LR_dup_free,LR_identical,run_trans, init_threshold=0.8, c_bay=0.015):
+def run_zeroer(similarity_features_df, similarity_features_lr,id_dfs,true_labels,LR_dup_free,LR_identical,run_trans, init_threshold=0.8, c_bay=0.015,
+               init_params=None, params_path=None, dtype=np.float64):
     # Check and normalize features if needed
     from sklearn.preprocessing import MinMaxScaler
     feature_min = similarity_features_df.min().min()
@@ -72,7 +75,9 @@ def run_zeroer(similarity_features_df, similarity_features_lr,id_dfs,true_labels
 
     print(f"Using c_bay={c_bay} (paper default: 0.015)")
     model, y_pred = ZeroerModel.run_em(similarity_matrixs, feature_names, y_inits,id_dfs,LR_dup_free,LR_identical, run_trans, y_true=true_labels,
-                                       hard=False, c_bay=c_bay)
+                                       hard=False, c_bay=c_bay, init_params=init_params, dtype=dtype)
+    if params_path is not None:
+        pickle.dump(model.get_params(), open(params_path, 'wb'))
     if true_labels is not None:
         p, r, f1 = get_results(true_labels, np.round(np.clip(y_pred + DEL, 0., 1.)).astype(int))
         print("Results after EM:")
@@ -8,21 +8,34 @@ os.environ['NUMEXPR_NUM_THREADS'] = '1'
 os.environ['GOTO_NUM_THREADS'] = '1'
 os.environ['VECLIB_MAXIMUM_THREADS'] = '1'
 
-from data_loading_helper.data_loader import load_data
+from data_loading_helper.candidate_set import CandidateSet, blocks_per_pair
 from data_loading_helper.feature_extraction import *
+from data_loading_helper.feature_store import STORE_FORMATS, feature_store_path, load_features, save_features
+from data_loading_helper.feature_cache import FeatureCache, latest_feature_dir
+from data_loading_helper.incremental import has_table_state, update_features
+from data_loading_helper.pipelines import generate_feature_tables
+from data_loading_helper.streaming import stream_feature_tables
+from model import encode_id_pairs
 from utils import run_zeroer
 from blocking_functions import *
 from os.path import join
 import argparse
+import pickle
 import sys
 parser = argparse.ArgumentParser()
 parser.add_argument("dataset",type=str)
 parser.add_argument("--run_transitivity",type=bool,default=False,nargs="?",const=True, help="whether to enforce transitivity constraint")
 parser.add_argument("--LR_dup_free",type=bool,default=False,nargs="?",const=True, help="are the left table and right table duplicate-free?")
 parser.add_argument("--LR_identical",type=bool,default=False,nargs="?",const=True, help="are the left table and right table identical?")
-parser.add_argument("--n_jobs",type=int,default=4, help="number of parallel jobs for feature extraction (default: 4, use -1 for all cores)")
+parser.add_argument("--n_jobs",type=int,default=4, help="number of parallel jobs for feature extraction, shared by the LxR/LxL/RxR pipelines run concurrently with --run_transitivity (default: 4, use -1 for all cores)")
 parser.add_argument("--init_threshold",type=float,default=0.8, help="initialization threshold for positive samples (default: 0.8, paper default: 0.5)")
 parser.add_argument("--c_bay",type=float,default=0.015, help="regularization parameter kappa' (default: 0.015, paper default: 0.01, range: [0, 0.1])")
+parser.add_argument("--incremental",type=bool,default=False,nargs="?",const=True, help="only block and extract features for new/changed records since the last run, and warm-start EM from its parameters")
+parser.add_argument("--feature_store",type=str,default="npy",choices=STORE_FORMATS, help="format used to store generated features (default: npy, a memory-mapped float32 matrix)")
+parser.add_argument("--blocking_func",type=str,default=None, help="name in blocking_functions_mapping of the blocking function to use instead of the dataset's (e.g. amazon_googleproducts_lsh, generic_lsh)")
+parser.add_argument("--streaming",type=bool,default=False,nargs="?",const=True, help="block and extract features a slice of the left table at a time, keeping only the float32 feature matrix (for multi-million-pair candsets)")
+parser.add_argument("--stream_block_size",type=int,default=5000, help="number of left table records blocked per chunk with --streaming (default: 5000)")
+parser.add_argument("--em_dtype",type=str,default="float64",choices=["float64","float32"], help="storage type of the similarity matrix and posteriors in EM; float32 halves its memory, sums and log-likelihoods stay float64 (default: float64)")
 
 data_path = "datasets"
 
@@ -35,87 +48,102 @@ if __name__ == '__main__':
     n_jobs = args.n_jobs
     init_threshold = args.init_threshold
     c_bay = args.c_bay
+    feature_store = args.feature_store
+    incremental = args.incremental
+    streaming = args.streaming
     dataset_path = join(data_path,dataset_name)
-    blocking_func = blocking_functions_mapping[dataset_name]
+    blocking_func = blocking_functions_mapping[args.blocking_func or dataset_name]
+    if streaming and not blocks_per_pair(blocking_func):
+        parser.error("--streaming blocks slices of the tables, which needs a blocker that decides per pair; "
+                     + (args.blocking_func or dataset_name) + " picks its settings from the whole tables")
     
     # Set environment variable for feature extraction
     import os
     os.environ['ZEROER_N_JOBS'] = str(n_jobs)
     print(f"Using {n_jobs} parallel jobs for feature extraction (set --n_jobs to change)")
+
+    f = open(join(dataset_path, 'metadata.txt'), "r")
+    LEFT_FILE = join(dataset_path, f.readline().strip())
+    if LR_identical:
+        RIGHT_FILE = LEFT_FILE
+    else:
+        RIGHT_FILE = join(dataset_path, f.readline().strip())
+    DUPLICATE_TUPLES = join(dataset_path, f.readline().strip())
+    f.close()
+
+    # Blocking output and features are cached under a key of everything they depend on
+    cache = FeatureCache(dataset_path, [join(dataset_path, 'metadata.txt'), LEFT_FILE, RIGHT_FILE], blocking_func,
+                         label_files=[DUPLICATE_TUPLES], LR_identical=LR_identical)
+    cache.prepare()
+    feature_dir = cache.feature_dir
+    previous_feature_dir = latest_feature_dir(dataset_path)
     try:
-        candset_features_df = pd.read_csv(join(dataset_path,"candset_features_df.csv"), index_col=0)
-        candset_features_df.reset_index(drop=True,inplace=True)
+        candset_features_df = load_features(feature_dir, "candset_features_df")
         if run_trans==True:
             id_df = candset_features_df[["ltable_id","rtable_id"]]
             id_df.reset_index(drop=True,inplace=True)
             if LR_dup_free==False and LR_identical==False:
-                candset_features_df_l = pd.read_csv(join(dataset_path,"candset_features_df_l.csv"), index_col=0)
-                candset_features_df_l.reset_index(drop=True,inplace=True)
-                candset_features_df_r = pd.read_csv(join(dataset_path,"candset_features_df_r.csv"), index_col=0)
-                candset_features_df_r.reset_index(drop=True,inplace=True)
+                candset_features_df_l = load_features(feature_dir, "candset_features_df_l")
+                candset_features_df_r = load_features(feature_dir, "candset_features_df_r")
                 id_df_l = candset_features_df_l[["ltable_id","rtable_id"]]
                 id_df_l.reset_index(drop=True,inplace=True)
                 id_df_r = candset_features_df_r[["ltable_id","rtable_id"]]
                 id_df_r.reset_index(drop=True,inplace=True)
-        print(
-            "Features already generated, reading from file: " + dataset_path + "/candset_features_df.csv")
+        print("Features already generated, read from store in: " + feature_dir)
 
     except FileNotFoundError:
-        print("Generating features and storing in: " + dataset_path + "/candset_features_df.csv", flush=True)
-        print(f"[ZEROER] Dataset: {dataset_name}", flush=True)
-        print(f"[ZEROER] Transitivity: {run_trans}, LR_dup_free: {LR_dup_free}, LR_identical: {LR_identical}", flush=True)
-
-        f = open(join(dataset_path, 'metadata.txt'), "r")
-        LEFT_FILE = join(dataset_path, f.readline().strip())
-        if LR_identical:
-            RIGHT_FILE = LEFT_FILE
-        else:
-            RIGHT_FILE = join(dataset_path, f.readline().strip())
-        DUPLICATE_TUPLES = join(dataset_path, f.readline().strip())
-        f.close()
-        print(f"[ZEROER] Files: LEFT={LEFT_FILE}, RIGHT={RIGHT_FILE}, MATCHES={DUPLICATE_TUPLES}", flush=True)
-        if run_trans==True and LR_dup_free==False and LR_identical==False:
-            ltable_df, rtable_df, duplicates_df, candset_df,candset_df_l,candset_df_r = load_data(LEFT_FILE, RIGHT_FILE, DUPLICATE_TUPLES,
-                                                                                              blocking_func,
-                                                                                              include_self_join=True)
+        update = incremental and previous_feature_dir != feature_dir and has_table_state(previous_feature_dir)
+        if update and not blocks_per_pair(blocking_func):
+            #Blocking only the new records would not give the pairs of blocking the whole tables
+            print("[INCREMENTAL] " + (args.blocking_func or dataset_name) + " picks its settings from the whole tables, "
+                  "blocking them again instead of updating " + previous_feature_dir, flush=True)
+            update = False
+        if update:
+            print("Updating features of the previous run in " + previous_feature_dir + " and storing in: " + feature_dir, flush=True)
+            include_self_join = run_trans==True and LR_dup_free==False and LR_identical==False
+            updated = update_features(previous_feature_dir, feature_dir, cache.blocking_dir, LEFT_FILE, RIGHT_FILE, DUPLICATE_TUPLES,
+                                      blocking_func, include_self_join=include_self_join, LR_identical=LR_identical, fmt=feature_store)
+            candset_features_df = updated["candset_features_df"]
+            id_df = candset_features_df[["ltable_id","rtable_id"]]
+            if include_self_join:
+                candset_features_df_l = updated["candset_features_df_l"]
+                candset_features_df_r = updated["candset_features_df_r"]
+                id_df_l = candset_features_df_l[["ltable_id","rtable_id"]]
+                id_df_r = candset_features_df_r[["ltable_id","rtable_id"]]
+        elif streaming:
+            print("Generating features (streaming) and storing in: " + feature_dir, flush=True)
+            include_self_join = run_trans==True and LR_dup_free==False and LR_identical==False
+            generated = stream_feature_tables(feature_dir, cache.blocking_dir, LEFT_FILE, RIGHT_FILE, DUPLICATE_TUPLES, blocking_func,
+                                              include_self_join=include_self_join, LR_identical=LR_identical, fmt=feature_store,
+                                              block_size=args.stream_block_size, n_jobs=n_jobs)
+            candset_features_df = generated["candset_features_df"]
+            id_df = candset_features_df[["ltable_id","rtable_id"]]
+            if include_self_join:
+                candset_features_df_l = generated["candset_features_df_l"]
+                candset_features_df_r = generated["candset_features_df_r"]
+                id_df_l = candset_features_df_l[["ltable_id","rtable_id"]]
+                id_df_r = candset_features_df_r[["ltable_id","rtable_id"]]
         else:
-            ltable_df, rtable_df, duplicates_df, candset_df = load_data(LEFT_FILE, RIGHT_FILE, DUPLICATE_TUPLES,
-                                                                                              blocking_func,
-                                                                                              include_self_join=False)
-            if LR_identical:
-                print("removing self matches")
-                candset_df = candset_df.loc[candset_df.ltable_id!=candset_df.rtable_id,:]
-                candset_df.reset_index(inplace=True,drop=True)
-                candset_df['_id'] = candset_df.index
-        if duplicates_df is None:
-            duplicates_df = pd.DataFrame(columns=["ltable_id", "rtable_id"])
-        print(f"[ZEROER] Starting feature extraction for {len(candset_df):,} candidate pairs...", flush=True)
-        sys.stdout.flush()
-        candset_features_df = gather_features_and_labels(ltable_df, rtable_df, duplicates_df, candset_df)
-        print(f"[ZEROER] Feature extraction completed. Saving to file...", flush=True)
-        sys.stdout.flush()
-        candset_features_df.to_csv(join(dataset_path,"candset_features_df.csv"))
-        print(f"[ZEROER] Features saved: {len(candset_features_df):,} rows, {len(candset_features_df.columns)} columns", flush=True)
-        id_df = candset_df[["ltable_id", "rtable_id"]]
-
-        if run_trans == True and LR_dup_free == False and LR_identical==False:
-            duplicates_df_r = pd.DataFrame()
-            duplicates_df_r['l_id'] = rtable_df["id"]
-            duplicates_df_r['r_id'] = rtable_df["id"]
-            candset_features_df_r = gather_features_and_labels(rtable_df, rtable_df, duplicates_df_r, candset_df_r)
-            candset_features_df_r.to_csv(join(dataset_path,"candset_features_df_r.csv"))
-
-
-            duplicates_df_l = pd.DataFrame()
-            duplicates_df_l['l_id'] = ltable_df["id"]
-            duplicates_df_l['r_id'] = ltable_df["id"]
-            candset_features_df_l = gather_features_and_labels(ltable_df, ltable_df, duplicates_df_l, candset_df_l)
-            candset_features_df_l.to_csv(join(dataset_path,"candset_features_df_l.csv"))
-
-            id_df_l = candset_df_l[["ltable_id","rtable_id"]]
-            id_df_r = candset_df_r[["ltable_id","rtable_id"]]
-            id_df_l.to_csv(join(dataset_path,"id_tuple_df_l.csv"))
-            id_df_r.to_csv(join(dataset_path,"id_tuple_df_r.csv"))
+            print("Generating features and storing in: " + feature_store_path(feature_dir, "candset_features_df", feature_store), flush=True)
+            print(f"[ZEROER] Dataset: {dataset_name}", flush=True)
+            print(f"[ZEROER] Transitivity: {run_trans}, LR_dup_free: {LR_dup_free}, LR_identical: {LR_identical}", flush=True)
+            print(f"[ZEROER] Files: LEFT={LEFT_FILE}, RIGHT={RIGHT_FILE}, MATCHES={DUPLICATE_TUPLES}", flush=True)
+            include_self_join = run_trans==True and LR_dup_free==False and LR_identical==False
+            # The LxR, LxL and RxR pipelines (blocking + features) run concurrently on n_jobs processes
+            generated = generate_feature_tables(feature_dir, cache.blocking_dir, LEFT_FILE, RIGHT_FILE, DUPLICATE_TUPLES, blocking_func,
+                                                include_self_join=include_self_join, LR_identical=LR_identical, fmt=feature_store,
+                                                n_jobs=n_jobs, report_path=join(dataset_path, "blocking_report.json"))
+            candset_features_df = generated["candset_features_df"]
+            print(f"[ZEROER] Features saved: {len(candset_features_df):,} rows, {len(candset_features_df.columns)} columns", flush=True)
+            id_df = candset_features_df[["ltable_id","rtable_id"]]
+            if include_self_join:
+                candset_features_df_l = generated["candset_features_df_l"]
+                candset_features_df_r = generated["candset_features_df_r"]
+                id_df_l = candset_features_df_l[["ltable_id","rtable_id"]]
+                id_df_r = candset_features_df_r[["ltable_id","rtable_id"]]
+                id_df_l.to_csv(join(feature_dir,"id_tuple_df_l.csv"))
+                id_df_r.to_csv(join(feature_dir,"id_tuple_df_r.csv"))
+    cache.mark_latest()
 
     similarity_features_df = gather_similarity_features(candset_features_df)
     similarity_features_lr = (None,None)
@@ -134,6 +162,8 @@ if __name__ == '__main__':
             similarity_features_df_r = similarity_features_df_r[features]
             similarity_features_lr = (similarity_features_df_l,similarity_features_df_r)
             id_dfs = (id_df, id_df_l, id_df_r)
+        # Ids go to EM as int32 codes of one shared dictionary; pred.csv takes its ids from the candset
+        id_dfs = encode_id_pairs(id_dfs)
 
     true_labels = candset_features_df.gold.values
     if np.sum(true_labels)==0:
@@ -150,11 +180,21 @@ if __name__ == '__main__':
     # Run zeroER with improved parameters
     # Use paper default c_bay=0.015 and adjustable init_threshold
     print(f"Using init_threshold={init_threshold}, c_bay={c_bay}")
+    init_params = None
+    #Warm-start only from an earlier run's features: with equal cache keys previous_feature_dir is the directory this
+    #run writes, and its em_params.pkl would be this run's own cached output
+    warm_start = incremental and os.path.normpath(previous_feature_dir) != os.path.normpath(feature_dir)
+    if warm_start and os.path.exists(join(previous_feature_dir, "em_params.pkl")):
+        print("Warm-starting EM from the parameters in " + previous_feature_dir, flush=True)
+        init_params = pickle.load(open(join(previous_feature_dir, "em_params.pkl"), "rb"))
     y_pred = run_zeroer(similarity_features_df, similarity_features_lr,id_dfs,
                         true_labels ,LR_dup_free,LR_identical,run_trans,
                         init_threshold=init_threshold,
-                        c_bay=c_bay)
-    pred_df = candset_features_df[["ltable_id","rtable_id"]].copy()
-    pred_df['pred'] = y_pred
+                        c_bay=c_bay,
+                        init_params=init_params,
+                        params_path=join(feature_dir, "em_params.pkl"),
+                        dtype=np.dtype(args.em_dtype))
+    candset = CandidateSet.from_candset(candset_features_df)
+    pred_df = candset.to_frame(pred=y_pred)[["ltable_id","rtable_id","pred"]]
     pred_df.to_csv(join(dataset_path,"pred.csv"))
 